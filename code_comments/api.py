@@ -9,6 +9,23 @@ class ICodeCommentChangeListener(Interface):
     def comment_created(comment):
         """New comment created."""
 
+    def comments_created(comments):
+        """Several comments created at once.
+
+        Optional, listeners that don't implement it receive a
+        `comment_created` event for each of the comments instead.
+        """
+
+    def comment_deleted(comment):
+        """Comment deleted."""
+
+    def comments_deleted(comments):
+        """Several comments deleted at once.
+
+        Optional, listeners that don't implement it receive a
+        `comment_deleted` event for each of the comments instead.
+        """
+
 
 class CodeCommentSystem(Component):
     change_listeners = ExtensionPoint(ICodeCommentChangeListener)
@@ -19,3 +36,35 @@ class CodeCommentSystem(Component):
         """
         for listener in self.change_listeners:
             listener.comment_created(comment)
+
+    def comments_created(self, comments):
+        """
+        Emits one comments_created event for a batch of comments to all
+        listeners that handle it, and comment_created events to the others.
+        """
+        for listener in self.change_listeners:
+            if hasattr(listener, 'comments_created'):
+                listener.comments_created(comments)
+            else:
+                for comment in comments:
+                    listener.comment_created(comment)
+
+    def comment_deleted(self, comment):
+        """
+        Emits comment_deleted event to all listeners that handle it.
+        """
+        for listener in self.change_listeners:
+            if hasattr(listener, 'comment_deleted'):
+                listener.comment_deleted(comment)
+
+    def comments_deleted(self, comments):
+        """
+        Emits one comments_deleted event for a batch of comments to all
+        listeners that handle it, and comment_deleted events to the others.
+        """
+        for listener in self.change_listeners:
+            if hasattr(listener, 'comments_deleted'):
+                listener.comments_deleted(comments)
+            elif hasattr(listener, 'comment_deleted'):
+                for comment in comments:
+                    listener.comment_deleted(comment)
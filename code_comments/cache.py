@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import threading
+from collections import OrderedDict
+from time import time
+
+from trac.config import IntOption
+from trac.core import Component
+from trac.util import Markup
+
+
+class LRUCache(object):
+    """
+    A small thread-safe least-recently-used mapping.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > max(self.size, 0):
+                self._items.popitem(last=False)
+
+
+def text_hash(text):
+    return hashlib.md5((text or u'').encode('utf-8')).hexdigest()
+
+
+class CommentHTMLCache(Component):
+    """
+    Caches the wiki-rendered HTML of comments.
+
+    Rendered HTML is stored in the `code_comments_html` table, keyed by
+    comment id, and fronted by an in-process LRU. An entry is only valid
+    for the text hash and formatter generation it was rendered with, so
+    edited comments and bumping `html_cache_generation` both force a
+    re-render.
+    """
+
+    generation = IntOption('code_comments', 'html_cache_generation', 1,
+                           doc="Generation of the rendered comment HTML "
+                               "cache. Increase it to re-render all "
+                               "comments, e.g. after installing a wiki "
+                               "plugin that changes formatting.")
+
+    lru_size = IntOption('code_comments', 'html_cache_size', 5000,
+                         doc="Number of rendered comments to keep in the "
+                             "in-process cache.")
+
+    # Upper bound of ids in a single `IN` query.
+    prefetch_chunk_size = 500
+
+    def __init__(self):
+        self._lru = LRUCache(self.lru_size)
+
+    def get(self, comment_id, text):
+        """
+        Returns the cached HTML for the comment with the given id and text,
+        or `None` if there isn't a valid cached copy.
+        """
+        key = self._key(comment_id, text)
+        html = self._lru.get(key)
+        if html is None:
+            for html, in self.env.db_query("""
+                    SELECT html FROM code_comments_html
+                    WHERE comment_id=%s AND text_hash=%s AND generation=%s
+                    """, key):
+                self._lru.set(key, html)
+                break
+            else:
+                return None
+        return Markup(html)
+
+    def set(self, comment_id, text, html):
+        """
+        Stores the rendered HTML of a comment.
+        """
+        self.set_many([(comment_id, text, html)])
+
+    def set_many(self, comments):
+        """
+        Stores the rendered HTML of the given `(comment_id, text, html)`
+        triples in a single transaction.
+        """
+        rows = [self._key(comment_id, text) + (unicode(html),)
+                for comment_id, text, html in comments]
+        if not rows:
+            return
+        try:
+            with self.env.db_transaction as db:
+                for i in xrange(0, len(rows), self.prefetch_chunk_size):
+                    chunk = [row[0] for row
+                             in rows[i:i + self.prefetch_chunk_size]]
+                    db("""
+                        DELETE FROM code_comments_html
+                        WHERE comment_id IN (%s)
+                        """ % ','.join(['%s'] * len(chunk)), chunk)
+                db.executemany("""
+                    INSERT INTO code_comments_html
+                     (comment_id, text_hash, generation, html)
+                    VALUES (%s, %s, %s, %s)
+                    """, rows)
+        except self.env.db_exc.IntegrityError:
+            # Another request rendering the same comments stored them first
+            pass
+        for row in rows:
+            self._lru.set(row[:3], row[3])
+
+    def prefetch(self, comments):
+        """
+        Loads cached HTML for the given `(comment_id, text)` pairs into the
+        in-process cache with as few queries as possible. Returns the pairs
+        without a valid cached copy, which are left to render.
+        """
+        keys = {}
+        for comment_id, text in comments:
+            key = self._key(comment_id, text)
+            if key not in self._lru:
+                keys[comment_id] = key, text
+        ids = keys.keys()
+        for i in xrange(0, len(ids), self.prefetch_chunk_size):
+            chunk = ids[i:i + self.prefetch_chunk_size]
+            for comment_id, text_hash_, generation, html in \
+                    self.env.db_query("""
+                        SELECT comment_id, text_hash, generation, html
+                        FROM code_comments_html WHERE comment_id IN (%s)
+                        """ % ','.join(['%s'] * len(chunk)), chunk):
+                key, text = keys[comment_id]
+                if key == (comment_id, text_hash_, generation):
+                    self._lru.set(key, html)
+                    del keys[comment_id]
+        return [(comment_id, keys[comment_id][1])
+                for comment_id in sorted(keys)]
+
+    def invalidate(self, *comment_ids):
+        """
+        Drops the stored HTML of the given comments. In-process entries are
+        left to age out: they are keyed by text hash, so they can't go
+        stale.
+        """
+        comment_ids = list(comment_ids)
+        with self.env.db_transaction as db:
+            for i in xrange(0, len(comment_ids), self.prefetch_chunk_size):
+                chunk = comment_ids[i:i + self.prefetch_chunk_size]
+                db("""
+                    DELETE FROM code_comments_html WHERE comment_id IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk)
+
+    def _key(self, comment_id, text):
+        return comment_id, text_hash(text), self.generation
+
+
+class UserDirectory(Component):
+    """
+    Looks up the email address and display name of known users by username.
+
+    It is backed by Trac's known users cache, which is invalidated in all
+    processes whenever a user changes their name or email through Trac.
+    The cache is also dropped every `user_cache_ttl` seconds, to pick up
+    changes made behind Trac's back.
+    """
+
+    ttl = IntOption('code_comments', 'user_cache_ttl', 3600,
+                    doc="Seconds after which the known users (names and "
+                        "emails) are reloaded from the database, even if "
+                        "no change has been signalled.")
+
+    def __init__(self):
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def get_email(self, username, default=None):
+        name, email = self._users().get(username, (None, None))
+        return email or default
+
+    def get_name(self, username, default=None):
+        name, email = self._users().get(username, (None, None))
+        return name or default
+
+    def _users(self):
+        now = time()
+        if now >= self._expires:
+            with self._lock:
+                if now >= self._expires:
+                    if self._expires:
+                        self.env.invalidate_known_users_cache()
+                    self._expires = now + self.ttl
+        return self.env.get_known_users(as_dict=True)
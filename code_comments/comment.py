@@ -9,6 +9,9 @@ import trac.wiki.formatter
 from trac.mimeview.api import Context
 from time import strftime, localtime
 from code_comments import db
+from code_comments.api import CodeCommentSystem
+from code_comments.cache import CommentHTMLCache, UserDirectory
+from code_comments.search import CommentSearchIndex
 from trac.util import Markup
 from trac.web.href import Href
 from trac.test import Mock, MockPerm
@@ -22,43 +25,102 @@ VERSION = 1
 
 
 class Comment(object):
+    """
+    A code comment row.
+
+    Only the columns are set up front; the derived fields (`html`,
+    `email_md5`, the attachment info and `href()`) are computed on first
+    access and memoized, so callers that only need e.g. the author don't
+    pay for wiki rendering.
+    """
+
     columns = [column.name for column in db.schema['code_comments'].columns]
 
     required = 'text', 'author'
 
-    _email_map = None
+    # Attributes serialized by `CommentJSONEncoder`.
+    json_fields = columns + [
+        'html', 'email_md5', 'is_comment_to_attachment', 'attachment_ticket',
+        'attachment_filename', 'is_comment_to_changeset',
+        'is_comment_to_file',
+    ]
 
-    def __init__(self, req, env, data):
+    __slots__ = columns + ['req', 'env', '_batch', '_html', '_email_md5',
+                           '_attachment_info', '_href']
+
+    def __init__(self, req, env, data, batch=None):
         if isinstance(data, dict):
-            self.__dict__ = data
-        else:
-            self.__dict__ = dict(zip(self.columns, data))
+            data = [data.get(name) for name in self.columns]
+        for name, value in zip(self.columns, data):
+            setattr(self, name, value)
         self.env = env
         self.req = req
+        # `(id, text)` pairs of the comments selected along with this one,
+        # shared between them so that HTML is fetched in one go.
+        self._batch = batch
+        self._html = None
+        self._email_md5 = None
+        self._attachment_info = None
+        self._href = None
         if self._empty('version'):
             self.version = VERSION
         if self._empty('path'):
             self.path = ''
-        self.html = format_to_html(self.req, self.env, self.text)
-        email = self.email_map().get(self.author, 'baba@baba.net')
-        self.email_md5 = md5_hexdigest(email)
-        attachment_info = self.attachment_info()
-        self.is_comment_to_attachment = 'attachment' == self.type
-        self.attachment_ticket = attachment_info['ticket']
-        self.attachment_filename = attachment_info['filename']
-        self.is_comment_to_changeset = 'changeset' == self.type
-        self.is_comment_to_file = 'browser' == self.type
 
     def _empty(self, column_name):
         return not hasattr(self, column_name) or not getattr(self, column_name)
 
-    def email_map(self):
-        if Comment._email_map is None:
-            Comment._email_map = {}
-            for username, name, email in self.env.get_known_users():
-                if email:
-                    Comment._email_map[username] = email
-        return Comment._email_map
+    @property
+    def html(self):
+        if self._html is None:
+            self._html = self._render_html()
+        return self._html
+
+    @property
+    def email_md5(self):
+        if self._email_md5 is None:
+            email = UserDirectory(self.env).get_email(self.author,
+                                                      'baba@baba.net')
+            self._email_md5 = md5_hexdigest(email)
+        return self._email_md5
+
+    @property
+    def is_comment_to_attachment(self):
+        return 'attachment' == self.type
+
+    @property
+    def is_comment_to_changeset(self):
+        return 'changeset' == self.type
+
+    @property
+    def is_comment_to_file(self):
+        return 'browser' == self.type
+
+    @property
+    def attachment_ticket(self):
+        return self.attachment_info()['ticket']
+
+    @property
+    def attachment_filename(self):
+        return self.attachment_info()['filename']
+
+    def _render_html(self):
+        if self._empty('id'):
+            return format_to_html(self.req, self.env, self.text)
+        cache = CommentHTMLCache(self.env)
+        if self._batch:
+            # The comments of the batch missing from the cache are rendered
+            # together, to store them in a single transaction
+            missing = cache.prefetch(self._batch)
+            del self._batch[:]
+            cache.set_many([(id, text, format_to_html(self.req, self.env,
+                                                      text))
+                            for id, text in missing])
+        html = cache.get(self.id, self.text)
+        if html is None:
+            html = format_to_html(self.req, self.env, self.text)
+            cache.set(self.id, self.text, html)
+        return html
 
     def validate(self):
         missing = [
@@ -70,16 +132,23 @@ class Comment(object):
                              % ', '.join(missing))
 
     def href(self):
+        if self._href is None:
+            self._href = self._build_href()
+        return self._href
+
+    def _build_href(self):
+        # Comments loaded outside of a request, e.g. for notifications
+        base_href = self.req.href if self.req else self.env.href
         if self.is_comment_to_file:
-            href = self.req.href.browser(self.path, rev=self.revision,
-                                         codecomment=self.id)
+            href = base_href.browser(self.path, rev=self.revision,
+                                     codecomment=self.id)
         elif self.is_comment_to_changeset:
-            href = self.req.href.changeset(self.revision, codecomment=self.id)
+            href = base_href.changeset(self.revision, codecomment=self.id)
         elif self.is_comment_to_attachment:
-            href = self.req.href('/attachment/ticket/%d/%s'
-                                 % (self.attachment_ticket,
-                                    self.attachment_filename),
-                                 codecomment=self.id)
+            href = base_href('/attachment/ticket/%d/%s'
+                             % (self.attachment_ticket,
+                                self.attachment_filename),
+                             codecomment=self.id)
         if self.line and not self.is_comment_to_changeset:
             href += '#L' + str(self.line)
         return href
@@ -115,6 +184,11 @@ class Comment(object):
         return 'source:' + self.link_text()
 
     def attachment_info(self):
+        if self._attachment_info is None:
+            self._attachment_info = self._parse_attachment_info()
+        return self._attachment_info
+
+    def _parse_attachment_info(self):
         info = {'ticket': None, 'filename': None}
         if not self.path.startswith('attachment'):
             return info
@@ -134,15 +208,10 @@ class Comment(object):
                         localtime(self.time)).decode(encoding)
 
     def get_ticket_relations(self):
-        query = """
-            SELECT ticket FROM ticket_custom
-            WHERE name = 'code_comment_relation' AND
-             (VALUE LIKE '%(comment_id)d' OR
-              VALUE LIKE '%(comment_id)d,%%' OR
-              VALUE LIKE '%%,%(comment_id)d' OR
-              VALUE LIKE '%%,%(comment_id)d,%%')
-            """ % {'comment_id': self.id}
-        return set([int(row[0]) for row in self.env.db_query(query)])
+        return set([int(row[0]) for row in self.env.db_query("""
+            SELECT ticket FROM code_comment_ticket_relations
+            WHERE comment_id=%s
+            """, (self.id,))])
 
     def get_ticket_links(self):
         relations = self.get_ticket_relations()
@@ -150,17 +219,26 @@ class Comment(object):
         return format_to_html(self.req, self.env, ', '.join(links))
 
     def delete(self):
-        self.env.db_transaction("""
-            DELETE FROM code_comments WHERE id=%s
-            """, (self.id,))
+        with self.env.db_transaction as db:
+            db("""
+                DELETE FROM code_comments WHERE id=%s
+                """, (self.id,))
+            CommentHTMLCache(self.env).invalidate(self.id)
+            CommentSearchIndex(self.env).remove([self.id])
+        CodeCommentSystem(self.env).comment_deleted(self)
 
 
 class CommentJSONEncoder(json.JSONEncoder):
+    def __init__(self, *args, **kwargs):
+        # Attributes to serialize, defaults to `Comment.json_fields`
+        self.fields = kwargs.pop('fields', None)
+        json.JSONEncoder.__init__(self, *args, **kwargs)
+
     def default(self, o):
         if isinstance(o, Comment):
             for_json = dict([
                 (name, getattr(o, name))
-                for name in o.__dict__
+                for name in self.fields or o.json_fields
                 if isinstance(getattr(o, name), (basestring, int, list, dict))
             ])
             for_json['formatted_date'] = o.formatted_date()
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import re
+
 from code_comments.comments import Comments
 from genshi.builder import tag
 from trac.wiki.macros import WikiMacroBase
@@ -18,7 +20,70 @@ class CodeCommentLinkMacro(WikiMacroBase):
 
     def expand_macro(self, formatter, name, text, args):
         try:
-            comment = Comments(formatter.req, formatter.env).by_id(text)
-            return tag.a(comment.link_text(), href=comment.href())
-        except:
+            id = int(text)
+        except (TypeError, ValueError):
+            return ''
+        links = self._prefetch(formatter)
+        if id not in links:
+            # Not found in the text, e.g. the macro has been generated
+            self._load(formatter, links, [id])
+        link = links[id]
+        if link is None:
             return ''
+        return tag.a(link[0], href=link[1])
+
+    def _prefetch(self, formatter):
+        """
+        Returns the links of the comments, by id, cached for the request.
+
+        The first time a text is formatted, the comments of all the
+        macros it contains are loaded at once, along with all comments
+        related to the ticket being rendered, if any: these are linked from
+        the other comments of the ticket.
+        """
+        req = formatter.req
+        cache = getattr(req, '_code_comment_links', None)
+        if cache is None:
+            cache = _LinkCache()
+            if req is not None:
+                req._code_comment_links = cache
+        if getattr(formatter, '_code_comment_links_prefetched', False):
+            return cache.links
+        formatter._code_comment_links_prefetched = True
+
+        source = formatter.source
+        if not isinstance(source, basestring):
+            source = '\n'.join(source or ())
+        ids = set(int(id) for id in re.findall(self.re, source))
+        resource = formatter.context.resource
+        if resource.realm == 'ticket' and resource.id \
+                and resource.id not in cache.tickets:
+            cache.tickets.add(resource.id)
+            ids.update(comment_id for comment_id, in self.env.db_query("""
+                SELECT comment_id FROM code_comment_ticket_relations
+                WHERE ticket=%s
+                """, (resource.id,)))
+        self._load(formatter, cache.links, ids - set(cache.links))
+        return cache.links
+
+    def _load(self, formatter, links, ids):
+        if not ids:
+            return
+        comments = Comments(formatter.req, formatter.env).by_ids(ids)
+        for comment in comments:
+            try:
+                links[comment.id] = (comment.link_text(), comment.href())
+            except Exception:
+                links[comment.id] = None
+        for id in ids:
+            links.setdefault(id, None)
+
+
+class _LinkCache(object):
+    """
+    Links of the comments loaded while processing a request.
+    """
+
+    def __init__(self):
+        self.links = {}
+        self.tickets = set()
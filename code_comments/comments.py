@@ -1,46 +1,66 @@
 # -*- coding: utf-8 -*-
 
+import base64
+import json
 import os.path
+import sys
 from time import time
 
-from code_comments.api import CodeCommentSystem
-from code_comments.comment import Comment
+from trac.admin import AdminCommandError, IAdminCommandProvider
+from trac.cache import cached
+from trac.core import Component, implements
+from trac.util.text import printout
+
+from code_comments import db
+from code_comments.api import CodeCommentSystem, ICodeCommentChangeListener
+from code_comments.cache import CommentHTMLCache
+from code_comments.search import CommentSearchIndex
+from code_comments.comment import Comment, CommentJSONEncoder
 
 
 class Comments(object):
 
     FILTER_MAX_PATH_DEPTH = 2
 
+    # Upper bound of ids in a single `IN` query.
+    IDS_CHUNK_SIZE = 500
+
+    # Number of comments fetched per query when iterating over many.
+    ITER_CHUNK_SIZE = 1000
+
     def __init__(self, req, env):
         self.req, self.env = req, env
         self.valid_sorting_methods = ('id', 'author', 'time', 'path', 'text')
 
-    def comment_from_row(self, row):
-        return Comment(self.req, self.env, row)
+    def comment_from_row(self, row, batch=None):
+        return Comment(self.req, self.env, row, batch)
 
     def get_filter_values(self):
-        comments = self.all()
-        return {
-            'paths': self.get_all_paths(comments),
-            'authors': self.get_all_comment_authors(comments),
-        }
+        return CommentFilterValues(self.env).values
 
-    def get_all_paths(self, comments):
+    def get_all_paths(self):
         def get_directory(path):
             parts = os.path.split(path)[0].split('/')
             return '/'.join(parts[:self.FILTER_MAX_PATH_DEPTH])
         paths = [
-            get_directory(comment.path)
-            for comment in comments if get_directory(comment.path)
+            get_directory(path)
+            for path, in self.env.db_query("""
+                SELECT DISTINCT path FROM code_comments
+                """) if path and get_directory(path)
         ]
         return sorted(set(paths))
 
-    def get_all_comment_authors(self, comments):
-        return sorted(list(set([comment.author for comment in comments])))
+    def get_all_comment_authors(self):
+        return sorted([author for author, in self.env.db_query("""
+            SELECT DISTINCT author FROM code_comments
+            """)])
 
     def select(self, *query):
-        return [self.comment_from_row(row)
-                for row in self.env.db_query(*query)]
+        rows = self.env.db_query(*query)
+        id_index = Comment.columns.index('id')
+        text_index = Comment.columns.index('text')
+        batch = [(row[id_index], row[text_index]) for row in rows]
+        return [self.comment_from_row(row, batch) for row in rows]
 
     def count(self, args={}):
         conditions_str, values = \
@@ -56,12 +76,94 @@ class Comments(object):
 
         return result['count']
 
+    def count_by_line(self, args={}):
+        """
+        Returns the number of comments matching `args` on each line that
+        has any, by line.
+        """
+        conditions_str, values = \
+            self.get_condition_str_and_corresponding_values(args)
+        where = ''
+        if conditions_str:
+            where = 'WHERE ' + conditions_str
+        return dict(self.env.db_query("""
+            SELECT line, COUNT(*) FROM code_comments
+            """ + where + ' GROUP BY line', values))
+
+    def fingerprint(self, args={}):
+        """
+        Returns a `(count, max_id, max_time)` tuple for the comments matching
+        the arguments, which changes whenever one of them is added or
+        deleted.
+        """
+        conditions_str, values = \
+            self.get_condition_str_and_corresponding_values(args)
+        where = ''
+        if conditions_str:
+            where = 'WHERE ' + conditions_str
+        for count, max_id, max_time in self.env.db_query("""
+                SELECT COUNT(*), MAX(id), MAX(time) FROM code_comments
+                """ + where, values):
+            return count, max_id or 0, max_time or 0
+
     def all(self):
         return self.search({}, order='DESC')
 
+    def iter_all(self, args={}):
+        """
+        Yields all comments matching `args` in order of id. They are
+        fetched in chunks, by key, so that memory use doesn't grow with the
+        number of comments.
+        """
+        conditions_str, values = \
+            self.get_condition_str_and_corresponding_values(args)
+        conditions = ['id > %s']
+        if conditions_str:
+            conditions.append(conditions_str)
+        last_id = 0
+        while True:
+            comments = self.select("""
+                SELECT * FROM code_comments WHERE %s
+                ORDER BY id LIMIT %d
+                """ % (' AND '.join(conditions), self.ITER_CHUNK_SIZE),
+                [last_id] + values)
+            for comment in comments:
+                yield comment
+            if len(comments) < self.ITER_CHUNK_SIZE:
+                break
+            last_id = comments[-1].id
+
+    def export(self, args={}, html=True):
+        """
+        Yields the comments matching `args` as lines of NDJSON, one JSON
+        object per comment, optionally without the rendered HTML.
+        """
+        fields = None
+        if not html:
+            fields = [name for name in Comment.json_fields if name != 'html']
+        encoder = CommentJSONEncoder(fields=fields)
+        for comment in self.iter_all(args):
+            yield encoder.encode(comment) + '\n'
+
     def by_id(self, id):
         return self.select("SELECT * FROM code_comments WHERE id=%s", [id])[0]
 
+    def by_ids(self, ids):
+        """
+        Returns the comments with the given ids in the same order, fetched
+        with as few queries as possible. Unknown ids are skipped.
+        """
+        ids = [int(id) for id in ids]
+        unique_ids = list(set(ids))
+        comments = {}
+        for i in xrange(0, len(unique_ids), self.IDS_CHUNK_SIZE):
+            chunk = unique_ids[i:i + self.IDS_CHUNK_SIZE]
+            for comment in self.select("""
+                    SELECT * FROM code_comments WHERE id IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk):
+                comments[comment.id] = comment
+        return [comments[id] for id in ids if id in comments]
+
     def assert_name(self, name):
         if name not in Comment.columns:
             raise ValueError("Column '%s' doesn't exist." % name)
@@ -81,13 +183,98 @@ class Comments(object):
         if per_page:
             limit = ' LIMIT %d OFFSET %d' % (per_page, (page - 1) * per_page)
         return self.select('SELECT * FROM code_comments ' + where +
-                           ' ORDER BY ' + order_by + ' ' + order + limit,
-                           values)
+                           ' ORDER BY ' + self.order_by_str(order_by, order) +
+                           limit, values)
+
+    def search_page(self, args, order='ASC', per_page=50, cursor=None,
+                    order_by='time'):
+        """
+        Like `search()`, but pages by key instead of by offset: `cursor` is
+        a token returned by a previous call and the page starts right after
+        (or ends right before) the comment it points to.
+
+        Returns a `(comments, next_cursor, previous_cursor)` tuple, where
+        the cursors are `None` if there is no such page.
+        """
+        if order_by not in self.valid_sorting_methods:
+            order_by = 'time'
+        if order != 'ASC':
+            order = 'DESC'
+        conditions_str, values = \
+            self.get_condition_str_and_corresponding_values(args)
+        conditions = [conditions_str] if conditions_str else []
+        direction = 'next'
+        if cursor:
+            direction, value, id = self.decode_cursor(cursor, order_by, order)
+            operator = '>' if (order == 'ASC') == (direction == 'next') \
+                else '<'
+            if order_by == 'id':
+                conditions.append('id %s %%s' % operator)
+                values.append(id)
+            else:
+                conditions.append('(%(col)s %(op)s %%s OR '
+                                  '(%(col)s = %%s AND id %(op)s %%s))'
+                                  % {'col': order_by, 'op': operator})
+                values.extend([value, value, id])
+        where = ''
+        if conditions:
+            where = 'WHERE ' + ' AND '.join(conditions)
+        query_order = order
+        if direction == 'prev':
+            query_order = 'DESC' if order == 'ASC' else 'ASC'
+        comments = self.select('SELECT * FROM code_comments ' + where +
+                               ' ORDER BY ' +
+                               self.order_by_str(order_by, query_order) +
+                               ' LIMIT %d' % (per_page + 1), values)
+        has_more = len(comments) > per_page
+        comments = comments[:per_page]
+        if direction == 'prev':
+            comments.reverse()
+        next_cursor = previous_cursor = None
+        if comments:
+            if has_more or direction == 'prev':
+                next_cursor = self.encode_cursor(comments[-1], order_by,
+                                                 order, 'next')
+            if cursor and (has_more or direction == 'next'):
+                previous_cursor = self.encode_cursor(comments[0], order_by,
+                                                     order, 'prev')
+        return comments, next_cursor, previous_cursor
+
+    def order_by_str(self, order_by, order):
+        if order_by == 'id':
+            return 'id ' + order
+        # Break ties by id, so that paging is stable
+        return '%s %s, id %s' % (order_by, order, order)
+
+    def encode_cursor(self, comment, order_by, order, direction):
+        data = [order_by, order, direction, getattr(comment, order_by),
+                comment.id]
+        return base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+
+    def decode_cursor(self, cursor, order_by, order):
+        try:
+            cursor = str(cursor)
+            data = json.loads(base64.urlsafe_b64decode(
+                cursor + '=' * (-len(cursor) % 4)))
+            cursor_order_by, cursor_order, direction, value, id = data
+        except (TypeError, ValueError, UnicodeError):
+            raise ValueError("Invalid cursor.")
+        if (cursor_order_by, cursor_order) != (order_by, order) or \
+                direction not in ('next', 'prev'):
+            raise ValueError("Cursor doesn't match the sort order.")
+        return direction, value, id
 
     def get_condition_str_and_corresponding_values(self, args):
         conditions = []
         values = []
         for name in args:
+            if name == 'q':
+                # Full-text search
+                condition, condition_values = \
+                    CommentSearchIndex(self.env).condition(args[name])
+                conditions.append(condition)
+                values.extend(condition_values)
+                continue
             if not name.endswith('__in') and not name.endswith('__prefix'):
                 values.append(args[name])
             if name.endswith('__gt'):
@@ -116,22 +303,241 @@ class Comments(object):
         return conditions_str, values
 
     def create(self, args):
-        comment = Comment(self.req, self.env, args)
-        comment.validate()
-        comment.time = int(time())
-        column_names_to_insert = [n for n in comment.columns if n != 'id']
-        values = [getattr(comment, n) for n in column_names_to_insert]
-        comment_id = [None]
+        return self.create_many([args])[0].id
+
+    def create_many(self, args_list):
+        """
+        Creates a comment for each dict of `args_list` in a single
+        transaction and returns them. Nothing is created if any of them is
+        invalid.
+        """
+        now = int(time())
+        comments = []
+        for args in args_list:
+            comment = Comment(self.req, self.env, self._coerce(args))
+            comment.validate()
+            comment.time = now
+            comments.append(comment)
+        if not comments:
+            return comments
+
+        with self.env.db_transaction:
+            self.insert(comments)
+
+            # Listeners take part in the transaction, so that e.g. queued
+            # notifications are only stored along with the comments
+            CodeCommentSystem(self.env).comments_created(comments)
+
+        return comments
+
+    def insert(self, comments, keep_ids=False):
+        """
+        Stores validated comments along with their search index entries,
+        without notifying listeners. New ids are assigned to the comments,
+        unless `keep_ids` is set.
+        """
+        column_names_to_insert = [n for n in Comment.columns
+                                  if keep_ids or n != 'id']
+        insert = """
+            INSERT INTO code_comments (%s) VALUES(%s)
+            """ % (', '.join(column_names_to_insert),
+                   ', '.join(['%s'] * len(column_names_to_insert)))
 
         with self.env.db_transaction as db:
             cursor = db.cursor()
-            cursor.execute("""
-                INSERT INTO code_comments (%s) VALUES(%s)
-                """ % (', '.join(column_names_to_insert),
-                       ', '.join(['%s'] * len(values))), values)
-            comment_id[0] = db.get_last_id(cursor, 'code_comments')
+            for comment in comments:
+                cursor.execute(insert, [getattr(comment, n)
+                                        for n in column_names_to_insert])
+                if not keep_ids:
+                    comment.id = db.get_last_id(cursor, 'code_comments')
+            CommentSearchIndex(self.env).add(comments)
+
+    def delete_many(self, comments):
+        """
+        Deletes the given comments in a single transaction.
+        """
+        if not comments:
+            return
+        ids = [comment.id for comment in comments]
+        with self.env.db_transaction as db:
+            for i in xrange(0, len(ids), self.IDS_CHUNK_SIZE):
+                chunk = ids[i:i + self.IDS_CHUNK_SIZE]
+                db("""
+                    DELETE FROM code_comments WHERE id IN (%s)
+                    """ % ','.join(['%s'] * len(chunk)), chunk)
+            CommentHTMLCache(self.env).invalidate(*ids)
+            CommentSearchIndex(self.env).remove(ids)
+        CodeCommentSystem(self.env).comments_deleted(comments)
+
+    def _coerce(self, args):
+        """
+        Converts numeric strings to integers for integer columns, like the
+        database would, so that created comments look the same as selected
+        ones.
+        """
+        args = dict(args)
+        for column in db.schema['code_comments'].columns:
+            value = args.get(column.name)
+            if column.type == 'int' and isinstance(value, basestring) \
+                    and value.isdigit():
+                args[column.name] = int(value)
+        return args
+
+
+class CommentsAdmin(Component):
+    """
+    trac-admin commands for comments in bulk.
+    """
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+
+    # Number of comments imported per transaction
+    import_chunk_size = 1000
+
+    def get_admin_commands(self):
+        yield ('code-comments import', '[--keep-ids] [--notify] <file>',
+               """Imports comments from NDJSON, one JSON object per line,
+               as written by `code-comments export`.
+
+               Use - as file to read from standard input. Comments are
+               imported in chunks of %d per transaction. Invalid lines are
+               reported and skipped.
+
+               With --keep-ids the comments keep the ids from the file,
+               otherwise they get new ones. Listeners, e.g. notifications
+               and subscriptions, are only told about the imported
+               comments with --notify, once per chunk.
+               """ % self.import_chunk_size,
+               None, self._do_import)
+        yield ('code-comments export', '[--no-html] [file]',
+               """Exports all comments as NDJSON, one JSON object per line.
+
+               The comments are written to standard output if no file is
+               given. With --no-html, the rendered HTML of the comments is
+               left out, which is much faster.
+               """,
+               None, self._do_export)
+
+    def import_comments(self, lines, keep_ids=False, notify=False):
+        """
+        Imports comments from an iterable of NDJSON lines. Returns the
+        numbers of imported comments and of skipped invalid lines.
+        """
+        comments = Comments(None, self.env)
+        imported = skipped = 0
+        chunk = []
+        # Input lines of the first and last comments of the chunk
+        first_line = last_line = None
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                data = json.loads(line)
+                if not isinstance(data, dict):
+                    raise ValueError("Not a JSON object")
+                data = comments._coerce(data)
+                if keep_ids and not data.get('id'):
+                    raise ValueError("Comment id missing")
+                comment = Comment(None, self.env, data)
+                comment.validate()
+                if not comment.time:
+                    comment.time = int(time())
+            except ValueError, e:
+                printout("Line %d skipped: %s" % (number, e))
+                skipped += 1
+                continue
+            if not chunk:
+                first_line = number
+            last_line = number
+            chunk.append(comment)
+            if len(chunk) >= self.import_chunk_size:
+                imported += self._import_chunk(chunk, keep_ids, notify,
+                                               first_line, last_line)
+                chunk = []
+                if imported % (10 * self.import_chunk_size) == 0:
+                    printout("%d comments imported..." % imported)
+        if chunk:
+            imported += self._import_chunk(chunk, keep_ids, notify,
+                                           first_line, last_line)
+
+        if keep_ids:
+            with self.env.db_transaction as db:
+                db.update_sequence(db.cursor(), 'code_comments')
+        del CommentFilterValues(self.env).values
+        return imported, skipped
+
+    def _import_chunk(self, chunk, keep_ids, notify, first_line, last_line):
+        try:
+            with self.env.db_transaction:
+                Comments(None, self.env).insert(chunk, keep_ids)
+                if notify:
+                    CodeCommentSystem(self.env).comments_created(chunk)
+        except self.env.db_exc.IntegrityError, e:
+            raise AdminCommandError("Importing lines %d to %d failed, the "
+                                    "previous ones have been imported: %s"
+                                    % (first_line, last_line, e))
+        return len(chunk)
+
+    def _do_import(self, *args):
+        args = list(args)
+        flags = {}
+        for flag in ('--keep-ids', '--notify'):
+            flags[flag] = flag in args
+            if flags[flag]:
+                args.remove(flag)
+        if len(args) != 1:
+            raise AdminCommandError("Invalid arguments", show_usage=True)
+        source = sys.stdin if args[0] == '-' else open(args[0], 'rb')
+        try:
+            imported, skipped = self.import_comments(
+                source, keep_ids=flags['--keep-ids'],
+                notify=flags['--notify'])
+        finally:
+            if source is not sys.stdin:
+                source.close()
+        printout("Imported %d comment(s), skipped %d invalid line(s)."
+                 % (imported, skipped))
+
+    def _do_export(self, *args):
+        args = list(args)
+        html = '--no-html' not in args
+        if not html:
+            args.remove('--no-html')
+        out = open(args[0], 'wb') if args else sys.stdout
+        try:
+            for line in Comments(None, self.env).export(html=html):
+                out.write(line)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+
+class CommentFilterValues(Component):
+    """
+    Caches the paths and authors offered by the filters of the comment list,
+    so they don't have to be computed on every hit of the list page.
+    """
+    implements(ICodeCommentChangeListener)
+
+    @cached
+    def values(self):
+        comments = Comments(None, self.env)
+        return {
+            'paths': comments.get_all_paths(),
+            'authors': comments.get_all_comment_authors(),
+        }
+
+    # ICodeCommentChangeListener methods
+
+    def comment_created(self, comment):
+        del self.values
+
+    def comments_created(self, comments):
+        del self.values
 
-        CodeCommentSystem(self.env).comment_created(
-            Comments(self.req, self.env).by_id(comment_id[0]))
+    def comment_deleted(self, comment):
+        del self.values
 
-        return comment_id[0]
+    def comments_deleted(self, comments):
+        del self.values
@@ -6,7 +6,7 @@ from trac.env import IEnvironmentSetupParticipant
 from trac.db.api import DatabaseManager
 
 # Database version identifier for upgrades.
-db_version = 3
+db_version = 11
 db_version_key = 'code_comments_schema_version'
 
 # Database schema
@@ -23,6 +23,11 @@ schema = {
         Column('type'),
         Index(['path']),
         Index(['author']),
+        # Comments of a page or line, as fetched by the browser and
+        # changeset views and the notification threads
+        Index(['type', 'path', 'revision', 'line']),
+        # Sorting by date on the list page and keyset pagination
+        Index(['time', 'id']),
     ],
     'code_comments_subscriptions': Table('code_comments_subscriptions',
                                          key=('id', 'user', 'type', 'path',
@@ -31,16 +36,70 @@ schema = {
         Column('user'),
         Column('type'),
         Column('path'),
+        Column('repos'),
         Column('rev'),
         Column('notify', type='bool'),
         Index(['user']),
         Index(['path']),
+        # The id being part of the key, duplicates are prevented here
+        Index(['user', 'type', 'path', 'repos', 'rev'], unique=True),
+    ],
+    'code_comments_html': Table('code_comments_html', key='comment_id')[
+        Column('comment_id', type='int'),
+        Column('text_hash'),
+        Column('generation', type='int'),
+        Column('html'),
+    ],
+    'code_comment_ticket_relations': Table('code_comment_ticket_relations',
+                                           key=('comment_id', 'ticket'))[
+        Column('comment_id', type='int'),
+        Column('ticket', type='int'),
+        Index(['comment_id']),
+        Index(['ticket']),
+    ],
+    # Portable full-text index of the comments, see `CommentSearchIndex`
+    'code_comments_terms': Table('code_comments_terms',
+                                 key=('term', 'comment_id'))[
+        Column('term'),
+        Column('comment_id', type='int'),
+        Column('count', type='int'),
+        Index(['comment_id']),
+    ],
+    'code_comments_notifications': Table('code_comments_notifications',
+                                         key='id')[
+        Column('id', auto_increment=True),
+        Column('comment_id', type='int'),
+        Column('time', type='int'),
+        Column('attempts', type='int'),
+        Column('next_attempt', type='int'),
+        Column('locked_until', type='int'),
+        Column('last_error'),
+        # Id of the first comment of a batch created at once, whose
+        # notifications are sent together; 0 for single comments
+        Column('batch', type='int'),
+        # Recipients already notified, one per line, skipped when retrying
+        Column('delivered_to'),
+        Index(['next_attempt']),
     ],
 }
 
 
 # Upgrades
 
+def create_indices(env, table, indices):
+    """
+    Creates the given indices of an existing table, using the same
+    statements as the database backend does when creating the table.
+    """
+    connector, args = DatabaseManager(env).get_connector()
+    table_with_indices = Table(table.name, key=table.key)[
+        list(table.columns) + list(indices)]
+    with env.db_transaction as db:
+        for sql in connector.to_sql(table_with_indices):
+            if sql.lstrip().startswith('CREATE') and ' INDEX ' in sql:
+                db(sql)
+
+
 def upgrade_from_1_to_2(env):
     with env.db_transaction as db:
         # Add the new column "type"
@@ -71,14 +130,128 @@ def upgrade_from_1_to_2(env):
 
 
 def upgrade_from_2_to_3(env):
-    # Add the new table
+    # Add the new table, as of version 3: later upgrades add indices to it
+    dbm = DatabaseManager(env)
+    dbm.create_tables((
+        Table('code_comments_subscriptions',
+              key=('id', 'user', 'type', 'path', 'repos', 'rev'))[
+            Column('id', auto_increment=True),
+            Column('user'),
+            Column('type'),
+            Column('path'),
+            Column('repos'),
+            Column('rev'),
+            Column('notify', type='bool'),
+            Index(['user']),
+            Index(['path']),
+        ],
+    ))
+
+
+def upgrade_from_3_to_4(env):
+    # Add the rendered HTML cache table
+    dbm = DatabaseManager(env)
+    dbm.create_tables((schema['code_comments_html'],))
+
+
+def upgrade_from_4_to_5(env):
+    # Add the ticket relations table and fill it from the comma-separated
+    # `code_comment_relation` ticket custom field
+    dbm = DatabaseManager(env)
+    dbm.create_tables((schema['code_comment_ticket_relations'],))
+    with env.db_transaction as db:
+        relations = set()
+        for ticket, value in db("""
+                SELECT ticket, value FROM ticket_custom
+                WHERE name='code_comment_relation'
+                """):
+            for comment_id in (value or '').split(','):
+                if comment_id.strip().isdigit():
+                    relations.add((int(comment_id), ticket))
+        cursor = db.cursor()
+        cursor.executemany("""
+            INSERT INTO code_comment_ticket_relations (comment_id, ticket)
+            VALUES (%s, %s)
+            """, list(relations))
+
+
+def upgrade_from_5_to_6(env):
+    # Add composite indices matching the comment queries
+    table = schema['code_comments']
+    create_indices(env, table,
+                   [index for index in table.indices
+                    if index.columns in (['type', 'path', 'revision', 'line'],
+                                         ['time', 'id'])])
+
+
+def upgrade_from_6_to_7(env):
+    # Add the notification outbox, as of version 7: later upgrades alter it
     dbm = DatabaseManager(env)
-    dbm.create_tables((schema['code_comments_subscriptions'],))
+    dbm.create_tables((
+        Table('code_comments_notifications', key='id')[
+            Column('id', auto_increment=True),
+            Column('comment_id', type='int'),
+            Column('time', type='int'),
+            Column('attempts', type='int'),
+            Column('next_attempt', type='int'),
+            Column('locked_until', type='int'),
+            Column('last_error'),
+            Index(['next_attempt']),
+        ],
+    ))
+
+
+def upgrade_from_7_to_8(env):
+    # Group the notifications of comments created together
+    with env.db_transaction as db:
+        db('ALTER TABLE code_comments_notifications ADD COLUMN batch INTEGER')
+        db('UPDATE code_comments_notifications SET batch=0')
+
+
+def upgrade_from_8_to_9(env):
+    # Add the full-text index of the comments and fill it
+    from code_comments.search import CommentSearchIndex
+    dbm = DatabaseManager(env)
+    dbm.create_tables((schema['code_comments_terms'],))
+    index = CommentSearchIndex(env)
+    index.create_fts_table()
+    index.rebuild()
+
+
+def upgrade_from_9_to_10(env):
+    # Drop duplicate subscriptions, keeping the oldest, and prevent new ones
+    with env.db_transaction as db:
+        # The derived table lets MySQL select from the table it deletes from
+        db("""
+            DELETE FROM code_comments_subscriptions WHERE id NOT IN (
+             SELECT id FROM (
+              SELECT MIN(id) AS id FROM code_comments_subscriptions
+              GROUP BY user, type, path, repos, rev) AS oldest)
+            """)
+    table = schema['code_comments_subscriptions']
+    create_indices(env, table,
+                   [index for index in table.indices if index.unique])
+
+
+def upgrade_from_10_to_11(env):
+    # Record the recipients of partly delivered notifications
+    with env.db_transaction as db:
+        db('ALTER TABLE code_comments_notifications '
+           'ADD COLUMN delivered_to TEXT')
+        db("UPDATE code_comments_notifications SET delivered_to=''")
 
 
 upgrade_map = {
     2: upgrade_from_1_to_2,
     3: upgrade_from_2_to_3,
+    4: upgrade_from_3_to_4,
+    5: upgrade_from_4_to_5,
+    6: upgrade_from_5_to_6,
+    7: upgrade_from_6_to_7,
+    8: upgrade_from_7_to_8,
+    9: upgrade_from_8_to_9,
+    10: upgrade_from_9_to_10,
+    11: upgrade_from_10_to_11,
 }
 
 
@@ -107,7 +280,9 @@ class CodeCommentsSetup(Component):
         dbm = DatabaseManager(self.env)
         current_ver = dbm.get_database_version(db_version_key)
         if current_ver == 0:
+            from code_comments.search import CommentSearchIndex
             dbm.create_tables(schema.values())
+            CommentSearchIndex(self.env).create_fts_table()
         else:
             while current_ver + 1 <= db_version:
                 upgrade_map[current_ver + 1](self.env)
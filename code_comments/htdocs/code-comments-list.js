@@ -1,13 +1,22 @@
 jQuery(document).ready(function($){
 
-	$('#send-to-ticket').click(function(e) {
-		e.preventDefault();
+	var goWithSelected = function(button, message) {
 		var ids = $('table.code-comments td.check input:checked' ).map(function(i, e) {return e.id.replace('checked-', '')}).get();
 		if (!ids.length) {
-			alert("Please select comments to include in the ticket.");
+			alert(message);
 			return;
 		}
-		window.location = $(this).attr('data-url') + '?ids=' + ids.join(',');
+		window.location = $(button).attr('data-url') + '?ids=' + ids.join(',');
+	};
+
+	$('#send-to-ticket').click(function(e) {
+		e.preventDefault();
+		goWithSelected(this, "Please select comments to include in the ticket.");
+	});
+
+	$('#delete-selected').click(function(e) {
+		e.preventDefault();
+		goWithSelected(this, "Please select comments to delete.");
 	});
 
 	$check_all_checkbox = $('th.check input');
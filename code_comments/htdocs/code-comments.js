@@ -32,16 +32,37 @@ var underscore = _.noConflict();
 			type: CodeComments.page,
 		},
 		fetchPageComments: function() {
-			return this.fetch( { data: _.extend( { line: 0 }, this.defaultFetchParams ) } );
+			return this.fetchAllPages( { data: _.extend( { line: 0 }, this.defaultFetchParams ) } );
 		},
 		fetchLineComments: function() {
-			return this.fetch( { data: _.extend( { line__gt: 0 }, this.defaultFetchParams ) } );
+			return this.fetchAllPages( { data: _.extend( { line__gt: 0 }, this.defaultFetchParams ) } );
+		},
+		fetchLineRange: function( first, last ) {
+			return this.fetchAllPages( { data: _.extend( { line__gt: first - 1, line__lt: last + 1 }, this.defaultFetchParams ) } );
+		},
+		// The server returns at most a page of comments per request and
+		// links the next one from the Link header
+		fetchAllPages: function( options ) {
+			var collection = this;
+			return this.fetch( _.extend( { remove: false }, options, {
+				success: function( collection, response, options ) {
+					var next = collection.nextPageUrl( options.xhr );
+					if ( next ) {
+						collection.fetchAllPages( { url: next } );
+					}
+				}
+			} ) );
+		},
+		nextPageUrl: function( xhr ) {
+			var links = xhr && xhr.getResponseHeader( 'Link' ),
+				match = /<([^>]*)>;\s*rel="next"/.exec( links || '' );
+			return match ? match[1] : null;
 		}
 	});
 
 	window.CommentView = Backbone.View.extend({
 		tagName: 'li',
-		template:  _.template(CodeComments.templates.comment),
+		template:  _.template(CodeCommentsTemplates.comment),
 		initialize: function() {
 			this.model.bind('change', this.render, this);
 			this.is_active = this.model.id == CodeComments.active_comment_id;
@@ -66,7 +87,7 @@ var underscore = _.noConflict();
 	window.PageCommentsView = Backbone.View.extend({
 		id: 'page-comments',
 
-		template:  _.template(CodeComments.templates.page_comments_block),
+		template:  _.template(CodeCommentsTemplates.page_comments_block),
 		events: {
 			'click button': 'showAddCommentDialog'
 		},
@@ -79,9 +100,18 @@ var underscore = _.noConflict();
 		render: function() {
 			$(this.el).html(this.template());
 			this.$('button').button();
-			PageComments.fetchPageComments();
 			return this;
 		},
+		// Once attached to the page, so that the active comment can be
+		// scrolled to
+		load: function() {
+			// Comments embedded into the page by the server, if any
+			if ( CodeComments.comments ) {
+				PageComments.reset( CodeComments.comments[0] || [] );
+			} else {
+				PageComments.fetchPageComments();
+			}
+		},
 
 		addOne: function(comment) {
 			var view = new CommentView({model: comment});
@@ -106,8 +136,48 @@ var underscore = _.noConflict();
 			LineComments.bind('reset', this.addAll, this);
 			this.viewPerLine = {};
 		},
+		// Without embedded comments, those of a block of lines are loaded
+		// when it comes near the viewport
+		blockSize: 200,
 		render: function() {
-			LineComments.fetchLineComments();
+			var view = this;
+			if ( CodeComments.comments ) {
+				LineComments.reset( _.flatten( _.values( _.omit( CodeComments.comments, '0' ) ), true ) );
+			} else if ( CodeComments.comment_counts ) {
+				this.setCounts( CodeComments.comment_counts );
+			} else {
+				$.getJSON( CodeComments.comment_counts_url, _.extend( { line__gt: 0 }, LineComments.defaultFetchParams ), function( counts ) {
+					view.setCounts( counts );
+				} );
+			}
+		},
+		setCounts: function( counts ) {
+			var view = this;
+			this.blocksWithComments = {};
+			this.loadedBlocks = {};
+			_.each( _.keys( counts ), function( line ) {
+				view.blocksWithComments[ Math.floor( ( line - 1 ) / view.blockSize ) ] = true;
+				$( Rows.getTrByLineNumber( line ) ).addClass( 'with-comments' );
+			} );
+			$( window ).on( 'scroll resize', $.throttle( 250, function() {
+				view.loadVisible();
+			} ) );
+			this.loadVisible();
+		},
+		loadVisible: function() {
+			var lines = Rows.getVisibleLineRange(), block, last;
+			if ( !lines ) {
+				return;
+			}
+			// One block of margin on both sides
+			block = Math.max( Math.floor( ( lines[0] - 1 ) / this.blockSize ) - 1, 0 );
+			last = Math.floor( ( lines[1] - 1 ) / this.blockSize ) + 1;
+			for ( ; block <= last; block++ ) {
+				if ( this.blocksWithComments[block] && !this.loadedBlocks[block] ) {
+					this.loadedBlocks[block] = true;
+					LineComments.fetchLineRange( block * this.blockSize + 1, ( block + 1 ) * this.blockSize );
+				}
+			}
 		},
 		addOne: function(comment) {
 			var line = comment.get('line');
@@ -130,7 +200,7 @@ var underscore = _.noConflict();
 	window.CommentsForALineView = Backbone.View.extend({
 		tagName: 'tr',
 		className: 'comments',
-		template: _.template(CodeComments.templates.comments_for_a_line),
+		template: _.template(CodeCommentsTemplates.comments_for_a_line),
 		initialize: function(attrs) {
 			this.line = attrs.line;
 		},
@@ -157,9 +227,10 @@ var underscore = _.noConflict();
 
 	window.AddCommentDialogView = Backbone.View.extend({
 		id: 'add-comment-dialog',
-		template:  _.template(CodeComments.templates.add_comment_dialog),
+		template:  _.template(CodeCommentsTemplates.add_comment_dialog),
 		events: {
 			'click button.add-comment': 'createComment',
+			'click button.add-to-review': 'addToReview',
 			'keyup textarea': 'previewThrottled'
 		},
 		initialize: function(options) {
@@ -175,12 +246,13 @@ var underscore = _.noConflict();
 			this.$el.keydown(function(e) {
 				e.stopPropagation();
 			});
-			this.$('button.add-comment').button();
+			this.$('button.add-comment, button.add-to-review').button();
 			return this;
 		},
 		open: function( collection, line, file, displayLine ) {
 			this.path = ( '' === CodeComments.path ) ? file : CodeComments.path;
 			this.line = line;
+			this.displayLine = displayLine || line;
 			this.collection = collection;
 			var title = this.buildDialogTitle( line, file, displayLine );
 			this.$el.dialog( 'open' ).dialog( { title: title } );
@@ -201,11 +273,20 @@ var underscore = _.noConflict();
 		close: function() {
 			$( 'button.ui-state-focus' ).blur();
 		},
+		commentAttributes: function() {
+			return {
+				text: this.$('textarea').val(),
+				author: CodeComments.username,
+				path: this.path,
+				revision: CodeComments.revision,
+				line: this.line? this.line : 0,
+				type: CodeComments.page
+			};
+		},
 		createComment: function(e) {
 			var self = this;
-			var text = this.$('textarea').val();
-			var line = this.line? this.line : 0;
-			if (!text) return;
+			var attributes = this.commentAttributes();
+			if (!attributes.text) return;
 			var options = {
 				success: function() {
 					self.$('textarea').val('');
@@ -213,14 +294,14 @@ var underscore = _.noConflict();
 				},
 				wait: true
 			};
-			this.collection.create({
-				text: text,
-				author: CodeComments.username,
-				path: this.path,
-				revision: CodeComments.revision,
-				line: line,
-				type: CodeComments.page
-			}, options);
+			this.collection.create(attributes, options);
+		},
+		addToReview: function(e) {
+			var attributes = this.commentAttributes();
+			if (!attributes.text) return;
+			ReviewDrafts.add(_.extend(attributes, {display_line: this.displayLine}));
+			this.$('textarea').val('');
+			this.$el.dialog('close');
 		},
 		previewThrottled: $.throttle(1500, function(e) { return this.preview(e); }),
 		preview: function(e) {
@@ -232,6 +313,81 @@ var underscore = _.noConflict();
 		}
 	});
 
+	// Comments staged by the user, kept in the browser's local storage
+	// until they are published at once with "Submit review"
+	window.ReviewDraftsList = Backbone.Collection.extend({
+		model: Comment,
+		initialize: function() {
+			this.storageKey = ['code-comments-review', CodeComments.page,
+				CodeComments.path, CodeComments.revision].join(':');
+			this.on('add remove reset', this.save, this);
+		},
+		load: function() {
+			var drafts = [];
+			try {
+				drafts = JSON.parse(window.localStorage.getItem(this.storageKey) || '[]');
+			} catch (e) {}
+			this.reset(drafts);
+		},
+		save: function() {
+			try {
+				if (this.length) {
+					window.localStorage.setItem(this.storageKey, JSON.stringify(this.toJSON()));
+				} else {
+					window.localStorage.removeItem(this.storageKey);
+				}
+			} catch (e) {}
+		},
+		// Creates all drafts in a single request and transaction, so that
+		// every recipient gets one notification for the whole review
+		submit: function() {
+			var drafts = this,
+				comments = this.map(function(draft) {
+					return _.omit(draft.toJSON(), 'display_line');
+				});
+			return $.ajax({
+				url: CodeComments.comments_rest_url,
+				type: 'POST',
+				contentType: 'application/json',
+				data: JSON.stringify(comments),
+				dataType: 'json',
+				success: function(created) {
+					_.each(created, function(comment) {
+						(comment.line ? LineComments : PageComments).add(comment);
+					});
+					drafts.reset();
+				}
+			});
+		}
+	});
+
+	window.ReviewBarView = Backbone.View.extend({
+		id: 'review-bar',
+		template: _.template(CodeCommentsTemplates.review_bar),
+		events: {
+			'click button.submit-review': 'submitReview',
+			'click button.discard-review': 'discardReview'
+		},
+		initialize: function() {
+			ReviewDrafts.on('add remove reset', this.render, this);
+		},
+		render: function() {
+			$(this.el).html(this.template({drafts: ReviewDrafts.toJSON()}))
+				.toggle(ReviewDrafts.length > 0);
+			this.$('button').button();
+			return this;
+		},
+		submitReview: function() {
+			this.$('button').button('disable');
+			ReviewDrafts.submit().fail(_.bind(this.render, this));
+		},
+		discardReview: function() {
+			if (confirm('Discard the ' + ReviewDrafts.length + ' comment(s) of your review?')) {
+				ReviewDrafts.reset();
+			}
+		}
+	});
+
 	window.LineCommentBubblesView = Backbone.View.extend({
 		render: function() {
 			var callbackMouseover = function( event ) {
@@ -272,6 +428,28 @@ var underscore = _.noConflict();
 		getTrByLineNumber: function( line ) {
 			return this.$rows[line - 1];
 		},
+		// The first and the last line at least partly in the viewport
+		getVisibleLineRange: function() {
+			var top = $( window ).scrollTop();
+			if ( !this.$rows.length ) {
+				return null;
+			}
+			return [ this.getLineAt( top ), this.getLineAt( top + $( window ).height() ) ];
+		},
+		// The last line starting above `y`, found by bisection as rows are
+		// in document order
+		getLineAt: function( y ) {
+			var low = 0, high = this.$rows.length - 1, middle;
+			while ( low < high ) {
+				middle = Math.ceil( ( low + high ) / 2 );
+				if ( $( this.$rows[middle] ).offset().top <= y ) {
+					low = middle;
+				} else {
+					high = middle - 1;
+				}
+			}
+			return low + 1;
+		},
 		wrapTHsInSpans: function() {
 			$( 'th', this.$rows ).each( function( i, elem ) {
 				elem.innerHTML = '<span>' + elem.innerHTML + '</span>';
@@ -314,14 +492,19 @@ var underscore = _.noConflict();
 	window.PageCommentsBlock = new PageCommentsView();
 	window.LineCommentsBlock = new LineCommentsView();
 	window.AddCommentDialog = new AddCommentDialogView();
+	window.ReviewDrafts = new ReviewDraftsList();
+	window.ReviewBar = new ReviewBarView();
 	window.LineCommentBubbles = new LineCommentBubblesView({el: $('#preview, .diff .entries')});
 	window.Rows = new RowsView( { tableSelector: 'table.code tbody, table.trac-diff tbody' } );
 
 	$(CodeComments.selectorToInsertAfter).after(PageCommentsBlock.render().el);
-	LineCommentsBlock.render();
+	$(PageCommentsBlock.el).before(ReviewBar.render().el);
+	PageCommentsBlock.load();
+	ReviewDrafts.load();
 	AddCommentDialog.render();
 	LineCommentBubbles.render();
 	Rows.render();
+	LineCommentsBlock.render();
 
 	window.Subscription = Backbone.Model.extend({
 		url: '/subscription' + location.pathname,
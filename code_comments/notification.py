@@ -1,25 +1,325 @@
 # -*- coding: utf-8 -*-
 
-from trac.config import BoolOption
+import os
+import threading
+from time import sleep, time
+
+from trac.admin import IAdminCommandProvider
+from trac.cache import CacheManager
+from trac.config import BoolOption, IntOption
 from trac.core import Component, implements
+from trac.env import env_cache
 from trac.notification import NotifyEmail
+from trac.util.text import exception_to_unicode, printout
+from trac.web.api import IRequestFilter
 
 from code_comments.api import ICodeCommentChangeListener
+from code_comments.cache import UserDirectory
 from code_comments.comments import Comments
 from code_comments.subscription import Subscription
 
 
 class CodeCommentChangeListener(Component):
     """
-    Sends email notifications when comments have been created.
+    Queues email notifications when comments have been created.
     """
     implements(ICodeCommentChangeListener)
 
     # ICodeCommentChangeListener methods
 
     def comment_created(self, comment):
+        CodeCommentNotificationQueue(self.env).enqueue([comment])
+
+    def comments_created(self, comments):
+        CodeCommentNotificationQueue(self.env).enqueue(comments)
+
+
+class CodeCommentNotificationQueue(Component):
+    """
+    Durable outbox for comment notifications.
+
+    Notifications are written to the `code_comments_notifications` table
+    in the same transaction as the comment, and delivered with retries by
+    background worker threads or by
+    `trac-admin <env> code-comments notifications deliver`.
+    """
+    implements(IAdminCommandProvider, IRequestFilter)
+
+    worker_threads = IntOption('code_comments', 'notification_worker_threads',
+                               1,
+                               doc="Number of background threads per "
+                                   "process delivering queued comment "
+                                   "notifications. Set to 0 to only deliver "
+                                   "them with `trac-admin <env> "
+                                   "code-comments notifications deliver`, "
+                                   "e.g. from cron.")
+
+    poll_interval = IntOption('code_comments', 'notification_poll_interval',
+                              5,
+                              doc="Seconds between checks of the "
+                                  "notification queue by the background "
+                                  "threads.")
+
+    max_attempts = IntOption('code_comments', 'notification_max_attempts', 5,
+                             doc="Number of times a comment notification "
+                                 "is attempted before giving up.")
+
+    retry_delay = IntOption('code_comments', 'notification_retry_delay', 60,
+                            doc="Seconds to wait before retrying a failed "
+                                "comment notification. The delay doubles "
+                                "with every failed attempt.")
+
+    digest_window = IntOption('code_comments', 'notification_digest_window',
+                              0,
+                              doc="Seconds to hold back comment "
+                                  "notifications, so that all comments made "
+                                  "on the same file, changeset or attachment "
+                                  "in the meantime are sent to each "
+                                  "recipient as a single digest. 0 disables "
+                                  "digests.")
+
+    # Seconds a claimed notification is reserved for the claiming worker
+    lease = 600
+
+    def __init__(self):
+        self._workers = []
+        self._workers_lock = threading.Lock()
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('code-comments notifications deliver', '',
+               """Delivers all comment notifications that are due.
+               """,
+               None, self._do_deliver)
+
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        if len(self._workers) < self.worker_threads:
+            self.start_workers()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # Public methods
+
+    def enqueue(self, comments):
+        """
+        Queues the notifications of the given comments. Notifications of
+        comments created together are delivered together, as one message
+        per recipient.
+        """
+        now = int(time())
+        batch = comments[0].id if len(comments) > 1 else 0
+        with self.env.db_transaction as db:
+            db.executemany("""
+                INSERT INTO code_comments_notifications
+                 (comment_id, time, attempts, next_attempt, locked_until,
+                  last_error, batch, delivered_to)
+                VALUES (%s, %s, 0, %s, 0, '', %s, '')
+                """, [(comment.id, now, now + max(self.digest_window, 0),
+                       batch) for comment in comments])
+
+    def deliver(self, limit=None):
+        """
+        Delivers due notifications until there are none left, or `limit`
+        have been processed. Returns the number of processed notifications.
+        """
+        processed = 0
+        while limit is None or processed < limit:
+            claimed = self.claim()
+            if not claimed:
+                break
+            self.deliver_claimed(claimed)
+            processed += len(claimed)
+        return processed
+
+    def claim(self):
+        """
+        Reserves the next due notification for this worker, along with the
+        other notifications of its batch, and all pending notifications on
+        the same resource when digests are enabled. Returns a list of
+        `(id, comment_id, attempts, delivered_to)` tuples, empty if nothing
+        is due.
+        """
+        now = int(time())
+        with self.env.db_transaction as db:
+            for row in db("""
+                    SELECT id, comment_id, attempts, delivered_to, batch
+                    FROM code_comments_notifications
+                    WHERE next_attempt<=%s AND locked_until<=%s
+                     AND attempts<%s
+                    ORDER BY next_attempt, id LIMIT 10
+                    """, (now, now, self.max_attempts)):
+                if self._lock_row(db, row[0], now):
+                    break
+            else:
+                return []
+            claimed = [row[:4]]
+            if row[4]:
+                for other in db("""
+                        SELECT id, comment_id, attempts, delivered_to
+                        FROM code_comments_notifications
+                        WHERE batch=%s AND id!=%s
+                         AND locked_until<=%s AND attempts<%s
+                        ORDER BY id
+                        """, (row[4], row[0], now, self.max_attempts)):
+                    if self._lock_row(db, other[0], now):
+                        claimed.append(other)
+            if self.digest_window > 0:
+                for other in db("""
+                        SELECT n.id, n.comment_id, n.attempts, n.delivered_to
+                        FROM code_comments_notifications AS n
+                         INNER JOIN code_comments AS c
+                          ON (c.id=n.comment_id)
+                         INNER JOIN code_comments AS claimed
+                          ON (claimed.type=c.type AND claimed.path=c.path
+                              AND claimed.revision=c.revision)
+                        WHERE claimed.id=%s AND n.id!=%s
+                         AND n.locked_until<=%s AND n.attempts<%s
+                        ORDER BY n.id
+                        """, (row[1], row[0], now, self.max_attempts)):
+                    if self._lock_row(db, other[0], now):
+                        claimed.append(other)
+            return claimed
+
+    def deliver_claimed(self, claimed):
+        comments = []
+        delivered = {}
+        for id, comment_id, attempts, delivered_to in claimed:
+            try:
+                comments.append(Comments(None, self.env).by_id(comment_id))
+            except IndexError:
+                # The comment has been deleted
+                continue
+            delivered[comment_id] = set(filter(None,
+                                               (delivered_to or '')
+                                               .split('\n')))
+        try:
+            if len(comments) > 1 or any(delivered.values()):
+                self.send_digests(comments, delivered)
+            elif comments:
+                CodeCommentNotifyEmail(self.env).notify(comments[0])
+        except Exception, e:
+            error = exception_to_unicode(e)
+            for id, comment_id, attempts, delivered_to in claimed:
+                self._failed(id, comment_id, attempts + 1, error)
+        else:
+            with self.env.db_transaction as db:
+                for id, comment_id, attempts, delivered_to in claimed:
+                    db("DELETE FROM code_comments_notifications WHERE id=%s",
+                       (id,))
+
+    def send_digests(self, comments, delivered=None):
+        """
+        Sends every recipient one message listing all the given comments
+        they should be notified of.
+
+        `delivered` maps comment ids to the recipients already notified of
+        them, who are skipped. Each message sent is recorded in it and in
+        the queue, so that a failure only leads to the failed recipients
+        being retried. The first failure is raised once all recipients
+        have been tried.
+        """
+        if delivered is None:
+            delivered = {}
         notifier = CodeCommentNotifyEmail(self.env)
-        notifier.notify(comment)
+        comments_by_recipient = {}
+        for comment in comments:
+            torcpts, ccrcpts = notifier.get_recipients(comment)
+            for recipient in torcpts | ccrcpts:
+                if recipient not in delivered.get(comment.id, ()):
+                    comments_by_recipient.setdefault(recipient, []) \
+                                         .append(comment)
+        error = None
+        for recipient, recipient_comments in \
+                sorted(comments_by_recipient.iteritems()):
+            try:
+                if len(recipient_comments) == 1:
+                    CodeCommentNotifyEmail(self.env).notify(
+                        recipient_comments[0], recipients=[recipient])
+                else:
+                    CodeCommentDigestEmail(self.env).notify(
+                        recipient_comments, recipient)
+            except Exception, e:
+                self.log.warning("Failure sending comment notification to "
+                                 "%s: %s", recipient,
+                                 exception_to_unicode(e))
+                error = error or e
+            else:
+                self._delivered(recipient, recipient_comments, delivered)
+        if error is not None:
+            raise error
+
+    def start_workers(self):
+        with self._workers_lock:
+            while len(self._workers) < self.worker_threads:
+                worker = threading.Thread(target=self._run_worker,
+                                          name='code-comments-notify')
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    # Internal methods
+
+    def _lock_row(self, db, id, now):
+        # Another worker may have claimed it in the meantime
+        cursor = db.cursor()
+        cursor.execute("""
+            UPDATE code_comments_notifications SET locked_until=%s
+            WHERE id=%s AND locked_until<=%s
+            """, (now + self.lease, id, now))
+        return cursor.rowcount == 1
+
+    def _delivered(self, recipient, comments, delivered):
+        with self.env.db_transaction as db:
+            for comment in comments:
+                recipients = delivered.setdefault(comment.id, set())
+                recipients.add(recipient)
+                db("""
+                    UPDATE code_comments_notifications SET delivered_to=%s
+                    WHERE comment_id=%s
+                    """, ('\n'.join(sorted(recipients)), comment.id))
+
+    def _failed(self, id, comment_id, attempts, error):
+        if attempts >= self.max_attempts:
+            self.log.error("Giving up sending notification on creation of "
+                           "comment #%d after %d attempts: %s",
+                           comment_id, attempts, error)
+        else:
+            self.log.warning("Failure sending notification on creation of "
+                             "comment #%d, will retry: %s", comment_id, error)
+        self.env.db_transaction("""
+            UPDATE code_comments_notifications
+            SET attempts=%s, next_attempt=%s, locked_until=0, last_error=%s
+            WHERE id=%s
+            """, (attempts,
+                  int(time()) + self.retry_delay * 2 ** (attempts - 1),
+                  error, id))
+
+    def _is_current(self):
+        # Trac shuts the environment down and opens a new one when trac.ini
+        # changes, which starts its own workers
+        path = os.path.normcase(os.path.normpath(self.env.path))
+        return env_cache.get(path) is self.env
+
+    def _run_worker(self):
+        while self._is_current():
+            # Pick up cache invalidations from other processes, which Trac
+            # otherwise only checks for at the start of each request
+            CacheManager(self.env).reset_metadata()
+            try:
+                self.deliver()
+            except Exception, e:
+                self.log.error("Comment notification worker failed: %s",
+                               exception_to_unicode(e, traceback=True))
+            sleep(self.poll_interval)
+
+    def _do_deliver(self):
+        count = self.deliver()
+        printout("Processed %d comment notification(s)." % count)
 
 
 class CodeCommentNotifyEmail(NotifyEmail):
@@ -34,17 +334,24 @@ class CodeCommentNotifyEmail(NotifyEmail):
     template_name = "code_comment_notify_email.txt"
     from_email = "trac+comments@localhost"
 
-    def _get_comment_thread(self, comment):
+    # Overrides the recipients determined by `get_recipients()`
+    recipients = None
+
+    def _get_previous_comment(self, comment):
         """
-        Returns all comments in the same location as a given comment, sorted
-        in order of id.
+        Returns the comment posted in the same location right before a given
+        comment, or `None` if it is the first one there. Later comments may
+        already exist when the notification is delivered from the queue.
         """
         comments = Comments(None, self.env)
         args = {'type': comment.type,
                 'revision': comment.revision,
                 'path': comment.path,
-                'line': comment.line}
-        return comments.search(args, order_by='id')
+                'line': comment.line,
+                'id__lt': comment.id}
+        previous = comments.search(args, order='DESC', per_page=1,
+                                   order_by='id')
+        return previous[0] if previous else None
 
     def get_recipients(self, comment):
         """
@@ -60,6 +367,9 @@ class CodeCommentNotifyEmail(NotifyEmail):
          sent to the author of the last comment in that location, and any other
          subscribers for that resource
         """
+        if self.recipients is not None:
+            return set(self.recipients), set()
+
         torcpts = set()
         ccrcpts = set()
 
@@ -68,10 +378,9 @@ class CodeCommentNotifyEmail(NotifyEmail):
             torcpts.add(subscription.user)
 
         # Is this a reply, or a new comment?
-        thread = self._get_comment_thread(comment)
-        if len(thread) > 1:
-            # The author of the comment before this one
-            torcpts.add(thread[-2].author)
+        previous = self._get_previous_comment(comment)
+        if previous is not None:
+            torcpts.add(previous.author)
 
         # Should we notify the comment author?
         if not self.notify_self:
@@ -88,13 +397,11 @@ class CodeCommentNotifyEmail(NotifyEmail):
         Get the real name of the user who made the comment. If it cannot be
         determined, return their username.
         """
-        for username, name, email in self.env.get_known_users():
-            if username == comment.author and name:
-                return name
-
-        return comment.author
+        return UserDirectory(self.env).get_name(comment.author,
+                                                comment.author)
 
-    def notify(self, comment):
+    def notify(self, comment, recipients=None):
+        self.recipients = recipients
         self.comment_author = self._get_author_name(comment)
 
         self.data.update({
@@ -106,11 +413,7 @@ class CodeCommentNotifyEmail(NotifyEmail):
         projname = self.config.get("project", "name")
         subject = "Re: [%s] %s" % (projname, comment.link_text())
 
-        try:
-            NotifyEmail.notify(self, comment, subject)
-        except Exception, e:
-            self.env.log.error("Failure sending notification on creation of "
-                               "comment #%d: %s", comment.id, e)
+        NotifyEmail.notify(self, comment, subject)
 
     def send(self, torcpts, ccrcpts):
         """
@@ -118,3 +421,34 @@ class CodeCommentNotifyEmail(NotifyEmail):
         """
         self.from_name = self.comment_author
         NotifyEmail.send(self, torcpts, ccrcpts)
+
+
+class CodeCommentDigestEmail(CodeCommentNotifyEmail):
+    """
+    Sends a single email notifying one recipient of several comments.
+    """
+
+    template_name = "code_comment_notify_digest_email.txt"
+
+    def notify(self, comments, recipient):
+        self.recipients = [recipient]
+        authors = []
+        for comment in comments:
+            author = self._get_author_name(comment)
+            if author not in authors:
+                authors.append(author)
+        self.comment_author = ', '.join(authors)
+
+        self.data.update({
+            "comments": [{
+                "comment": comment,
+                "comment_url": self.env.abs_href() + comment.href(),
+            } for comment in comments],
+            "project_url": self.env.project_url or self.env.abs_href(),
+        })
+
+        projname = self.config.get("project", "name")
+        subject = "Re: [%s] %s (%d new comments)" \
+                  % (projname, comments[0].link_text(), len(comments))
+
+        NotifyEmail.notify(self, comments, subject)
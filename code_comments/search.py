@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+from trac.admin import IAdminCommandProvider
+from trac.core import Component, implements
+from trac.db.api import DatabaseManager
+from trac.util.text import printout
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Shorter words are neither indexed nor searched for
+MIN_TERM_LENGTH = 2
+
+
+def tokenize(text):
+    """
+    Returns the lowercased words of `text`, mapped to their number of
+    occurrences.
+    """
+    counts = {}
+    for word in WORD_RE.findall((text or u'').lower()):
+        if len(word) >= MIN_TERM_LENGTH:
+            counts[word] = counts.get(word, 0) + 1
+    return counts
+
+
+class CommentSearchIndex(Component):
+    """
+    Full-text index of the text of the comments.
+
+    On SQLite builds with FTS5 the index is the `code_comments_fts` virtual
+    table. Elsewhere it is the portable `code_comments_terms` table, which
+    maps every word to the comments containing it. `Comments` updates the
+    index in the same transaction as the comments themselves.
+    """
+    implements(IAdminCommandProvider)
+
+    fts_table = 'code_comments_fts'
+
+    # Number of comments indexed per query when rebuilding
+    chunk_size = 1000
+
+    def __init__(self):
+        self._use_fts = None
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('code-comments search rebuild', '',
+               """Rebuilds the full-text index of the comments.
+               """,
+               None, self._do_rebuild)
+
+    # Public methods
+
+    @property
+    def use_fts(self):
+        if self._use_fts is None:
+            self._use_fts = self._is_sqlite() and bool(self.env.db_query("""
+                SELECT name FROM sqlite_master WHERE type='table' AND name=%s
+                """, (self.fts_table,)))
+        return self._use_fts
+
+    def create_fts_table(self):
+        """
+        Creates the FTS5 table if the database supports it. Returns whether
+        it has been created.
+        """
+        self._use_fts = None
+        if not self._is_sqlite():
+            return False
+        try:
+            with self.env.db_transaction as db:
+                db("CREATE VIRTUAL TABLE %s USING fts5(text)"
+                   % self.fts_table)
+        except self.env.db_exc.OperationalError, e:
+            self.log.info("Full-text search of comments falls back to the "
+                          "terms table, FTS5 is not available: %s", e)
+            return False
+        return True
+
+    def add(self, comments):
+        """
+        Indexes the text of the given comments.
+        """
+        with self.env.db_transaction as db:
+            if self.use_fts:
+                db.executemany("""
+                    INSERT INTO code_comments_fts (rowid, text)
+                    VALUES (%s, %s)
+                    """, [(comment.id, comment.text) for comment in comments])
+            else:
+                db.executemany("""
+                    INSERT INTO code_comments_terms (term, comment_id, count)
+                    VALUES (%s, %s, %s)
+                    """, [(term, comment.id, count)
+                          for comment in comments
+                          for term, count in tokenize(comment.text).items()])
+
+    def remove(self, comment_ids):
+        """
+        Drops the given comments from the index.
+        """
+        comment_ids = list(comment_ids)
+        if self.use_fts:
+            sql = "DELETE FROM code_comments_fts WHERE rowid IN (%s)"
+        else:
+            sql = "DELETE FROM code_comments_terms WHERE comment_id IN (%s)"
+        with self.env.db_transaction as db:
+            for i in xrange(0, len(comment_ids), self.chunk_size):
+                chunk = comment_ids[i:i + self.chunk_size]
+                db(sql % ','.join(['%s'] * len(chunk)), chunk)
+
+    def rebuild(self):
+        """
+        Indexes all comments from scratch. Returns the number of comments.
+        """
+        count = 0
+        last_id = 0
+        with self.env.db_transaction as db:
+            db("DELETE FROM %s" % ('code_comments_fts' if self.use_fts
+                                   else 'code_comments_terms'))
+            while True:
+                rows = db("""
+                    SELECT id, text FROM code_comments WHERE id>%s
+                    ORDER BY id LIMIT %s
+                    """, (last_id, self.chunk_size))
+                if not rows:
+                    break
+                self.add([_IndexedText(id, text) for id, text in rows])
+                count += len(rows)
+                last_id = rows[-1][0]
+        return count
+
+    def condition(self, query):
+        """
+        Returns an SQL condition on `code_comments.id` and its parameters,
+        matching the comments that contain all words of `query`.
+        """
+        terms = sorted(tokenize(query))
+        if not terms:
+            return '1=0', []
+        if self.use_fts:
+            return ('id IN (SELECT rowid FROM code_comments_fts '
+                    'WHERE code_comments_fts MATCH %s)',
+                    [self._fts_query(terms)])
+        return ('id IN (SELECT comment_id FROM code_comments_terms '
+                'WHERE term IN (%s) GROUP BY comment_id HAVING COUNT(*)=%%s)'
+                % ','.join(['%s'] * len(terms)), terms + [len(terms)])
+
+    def search(self, query, limit):
+        """
+        Returns the ids of the `limit` comments matching all words of
+        `query` best, most relevant first.
+        """
+        terms = sorted(tokenize(query))
+        if not terms:
+            return []
+        if self.use_fts:
+            rows = self.env.db_query("""
+                SELECT rowid FROM code_comments_fts
+                WHERE code_comments_fts MATCH %s
+                ORDER BY rank LIMIT %s
+                """, (self._fts_query(terms), limit))
+        else:
+            rows = self.env.db_query("""
+                SELECT comment_id FROM code_comments_terms
+                WHERE term IN (%s) GROUP BY comment_id HAVING COUNT(*)=%%s
+                ORDER BY SUM(count) DESC, comment_id DESC LIMIT %%s
+                """ % ','.join(['%s'] * len(terms)),
+                terms + [len(terms), limit])
+        return [id for id, in rows]
+
+    # Internal methods
+
+    def _is_sqlite(self):
+        return DatabaseManager(self.env).connection_uri.startswith('sqlite:')
+
+    def _fts_query(self, terms):
+        # Quoted, so that words like AND or NEAR aren't taken as operators
+        return ' '.join('"%s"' % term for term in terms)
+
+    def _do_rebuild(self):
+        count = self.rebuild()
+        printout("Indexed %d comment(s)." % count)
+
+
+class _IndexedText(object):
+    """
+    The part of a comment that is indexed.
+    """
+
+    def __init__(self, id, text):
+        self.id = id
+        self.text = text
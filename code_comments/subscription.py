@@ -2,19 +2,35 @@
 
 import json
 import re
+import threading
+from itertools import chain, product
 
 from trac.admin import IAdminCommandProvider
-from trac.attachment import Attachment, IAttachmentChangeListener
+from trac.attachment import IAttachmentChangeListener
+from trac.cache import cached
+from trac.config import BoolOption
 from trac.core import Component, implements
 from trac.util.html import html as tag
+from trac.util.text import exception_to_unicode, printout
 from trac.versioncontrol import (
-    RepositoryManager, NoSuchChangeset, IRepositoryChangeListener)
+    RepositoryManager, NoSuchChangeset, NoSuchNode,
+    IRepositoryChangeListener)
 from trac.web.api import HTTPNotFound, IRequestHandler, ITemplateStreamFilter
 
 from genshi.filters import Transformer
 
+from code_comments import db
 from code_comments.api import ICodeCommentChangeListener
-from code_comments.comments import Comments
+
+
+def path_ancestors(path):
+    """
+    Returns the directories containing `path`, from the repository root
+    (`''`) downwards, e.g. `['', 'trunk', 'trunk/billing']` for
+    `trunk/billing/invoice.py`.
+    """
+    parts = path.strip('/').split('/')[:-1]
+    return ['/'.join(parts[:depth]) for depth in xrange(len(parts) + 1)]
 
 
 class Subscription(object):
@@ -22,6 +38,9 @@ class Subscription(object):
     Representation of a code comment subscription.
     """
 
+    columns = [column.name for column in
+               db.schema['code_comments_subscriptions'].columns]
+
     id = 0
     user = ''
     type = ''
@@ -42,6 +61,8 @@ class Subscription(object):
         template = "{0} for {1} {2}"
         if self.type == "changeset":
             _identifier = self.rev
+        elif self.type == "directory":
+            _identifier = "{0}/".format(self.path)
         elif self.type == "browser":
             _identifier = "{0} @ {1}".format(self.path, self.rev)
         else:
@@ -53,47 +74,72 @@ class Subscription(object):
     def select(cls, env, args={}, notify=None):
         """
         Retrieve existing subscription(s).
-        """
-        select = 'SELECT * FROM code_comments_subscriptions'
 
+        `args` maps column names to a value, or to a tuple or list of
+        accepted values.
+        """
+        args = dict(args)
         if notify:
             args['notify'] = bool(notify)
 
-        if len(args) > 0:
-            select += ' WHERE '
-            criteria = []
-            for key, value in args.iteritems():
-                template = '{0}={1}'
-                if isinstance(value, basestring):
-                    template = '{0}=\'{1}\''
-                if (isinstance(value, tuple) or isinstance(value, list)):
-                    template = '{0} IN (\'{1}\')'
-                    value = '\',\''.join(value)
-                if isinstance(value, bool):
-                    value = int(value)
-                criteria.append(template.format(key, value))
-            select += ' AND '.join(criteria)
+        criteria, values = cls._criteria(args)
+        select = 'SELECT * FROM code_comments_subscriptions'
+        if criteria:
+            select += ' WHERE ' + ' AND '.join(criteria)
 
-        for row in env.db_query(select):
+        for row in env.db_query(select, values):
             yield cls._from_row(env, row)
 
+    @classmethod
+    def _criteria(cls, args):
+        """
+        Returns the SQL conditions and the corresponding parameters matching
+        the given `args`.
+        """
+        criteria = []
+        values = []
+        for key, value in sorted(args.iteritems()):
+            if key not in cls.columns:
+                raise ValueError("Unknown subscription column: %s" % key)
+            if isinstance(value, (tuple, list)):
+                criteria.append('%s IN (%s)'
+                                % (key, ','.join(['%s'] * len(value))))
+                values.extend(value)
+            else:
+                if isinstance(value, bool):
+                    value = int(value)
+                criteria.append('%s=%%s' % key)
+                values.append(value)
+        return criteria, values
+
     def insert(self):
         """
-        Insert a new subscription. Returns bool to indicate success.
+        Insert a new subscription. Returns bool to indicate success, which
+        fails if the same subscription already exists.
         """
         if self.id > 0:
             # Already has an id, don't insert
             return False
         else:
+            key = (self.user, self.type, self.path, self.repos, self.rev)
             with self.env.db_transaction as db:
+                # Checked by the statement itself rather than by catching
+                # the error of the unique index, which would abort the
+                # transaction of the caller on PostgreSQL
                 cursor = db.cursor()
                 cursor.execute("""
                     INSERT INTO code_comments_subscriptions
                      (user, type, path, repos, rev, notify)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    """, (self.user, self.type, self.path, self.repos,
-                          self.rev, self.notify))
+                    SELECT %s, %s, %s, %s, %s, %s FROM (SELECT 1) AS one
+                    WHERE NOT EXISTS (
+                     SELECT * FROM code_comments_subscriptions
+                     WHERE user=%s AND type=%s AND path=%s AND repos=%s
+                      AND rev=%s)
+                    """, key + (self.notify,) + key)
+                if cursor.rowcount != 1:
+                    return False
                 self.id = db.get_last_id(cursor, 'code_comments_subscriptions')
+                SubscriptionIndex(self.env).inserted()
                 return True
 
     def update(self):
@@ -105,12 +151,14 @@ class Subscription(object):
             return False
         else:
             try:
-                self.env.db_transaction("""
-                    UPDATE code_comments_subscriptions
-                    SET user=%s, type=%s, path=%s, repos=%s, rev=%s,
-                        notify=%s WHERE id=%s
-                    """, (self.user, self.type, self.path, self.repos,
-                          self.rev, self.notify, self.id))
+                with self.env.db_transaction as db:
+                    db("""
+                        UPDATE code_comments_subscriptions
+                        SET user=%s, type=%s, path=%s, repos=%s, rev=%s,
+                            notify=%s WHERE id=%s
+                        """, (self.user, self.type, self.path, self.repos,
+                              self.rev, self.notify, self.id))
+                    SubscriptionIndex(self.env).invalidate()
             except self.env.db_exc.IntegrityError:
                 self.env.log.warning("Subscription update failed.")
                 return False
@@ -121,9 +169,11 @@ class Subscription(object):
         Delete an existing subscription.
         """
         if self.id > 0:
-            self.env.db_transaction("""
-                DELETE FROM code_comments_subscriptions WHERE id=%s
-                """, (self.id,))
+            with self.env.db_transaction as db:
+                db("""
+                    DELETE FROM code_comments_subscriptions WHERE id=%s
+                    """, (self.id,))
+                SubscriptionIndex(self.env).invalidate()
 
     @classmethod
     def _from_row(cls, env, row):
@@ -177,7 +227,9 @@ class Subscription(object):
         if subscription is None:
             subscription = cls(env, dict_)
             if create:
-                subscription.insert()
+                if not subscription.insert():
+                    # Created concurrently
+                    return cls.from_dict(env, dict_, create=False)
                 env.log.info('Subscription created: [%d] %s',
                              subscription.id, subscription)
 
@@ -284,16 +336,22 @@ class Subscription(object):
     @classmethod
     def for_comment(cls, env, comment, notify=None):
         """
-        Return all subscriptions for a comment.
+        Return all subscriptions for a comment, including the subscriptions
+        to the directories containing the commented file.
         """
         args = {}
+        reponame = path = None
         if comment.type == 'attachment':
             args['type'] = comment.type
             args['path'] = comment.path.split(':')[1]
 
         if comment.type == 'changeset':
             args['type'] = comment.type
+            args['path'] = ''
             args['rev'] = str(comment.revision)
+            if comment.path:
+                rm = RepositoryManager(env)
+                reponame, _, path = rm.get_repository_by_path(comment.path)
 
         if comment.type == 'browser':
             rm = RepositoryManager(env)
@@ -303,7 +361,23 @@ class Subscription(object):
             args['repos'] = reponame
             args['rev'] = (str(comment.revision), '')
 
-        return cls.select(env, args, notify)
+        queries = [args]
+        if path:
+            # One lookup per directory level, however many subscriptions
+            # there are
+            queries.append({
+                'type': 'directory',
+                'path': tuple(path_ancestors(path)),
+                'repos': reponame,
+                'rev': '',
+            })
+
+        index = SubscriptionIndex(env)
+        if notify and index.enabled:
+            return chain.from_iterable(index.lookup(query)
+                                       for query in queries)
+        return chain.from_iterable(cls.select(env, query, notify)
+                                   for query in queries)
 
     @classmethod
     def for_request(cls, env, req, create=False):
@@ -331,12 +405,149 @@ class Subscription(object):
 
         if dict_['type'] == 'browser':
             reponame, repos, path = rm.get_repository_by_path(path)
-            dict_['path'] = '/' if len(path) == 0 else path
-            dict_['rev'] = req.args.get('rev') or ''
+            rev = req.args.get('rev') or ''
             dict_['repos'] = reponame
+            if cls._is_directory(repos, path, rev):
+                # Subscribes to all files below the directory, at any
+                # revision
+                dict_['type'] = 'directory'
+                dict_['path'] = path.strip('/')
+            else:
+                dict_['path'] = '/' if len(path) == 0 else path
+                dict_['rev'] = rev
 
         return cls.from_dict(env, dict_, create=create)
 
+    @staticmethod
+    def _is_directory(repos, path, rev):
+        if repos is None:
+            return False
+        try:
+            return repos.get_node(path, rev or None).isdir
+        except (NoSuchChangeset, NoSuchNode):
+            return False
+
+
+class SubscriptionIndex(Component):
+    """
+    In-process index of the subscriptions with notifications enabled, keyed
+    by `(repos, type, path, rev)`, so that the recipients of a comment
+    notification can be resolved without querying the database. Directory
+    subscriptions are found by looking up each ancestor of the commented
+    path.
+
+    The index is shared between processes through Trac's cache generations.
+    New subscriptions are added to it incrementally, while updating or
+    deleting any subscription rebuilds it.
+    """
+
+    enabled = BoolOption('code_comments', 'subscription_index', True,
+                         doc="Resolve the subscribers of new comments from "
+                             "an in-memory index instead of querying the "
+                             "database for every comment.")
+
+    keys = ('repos', 'type', 'path', 'rev')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @cached
+    def subscriptions(self):
+        return _IndexedSubscriptions(self.env.db_query("""
+            SELECT * FROM code_comments_subscriptions
+            """))
+
+    @cached
+    def extent(self):
+        """
+        The number of subscriptions and the greatest id, reloaded after
+        subscriptions have been inserted.
+        """
+        for count, last_id in self.env.db_query("""
+                SELECT COUNT(*), MAX(id) FROM code_comments_subscriptions
+                """):
+            return count, last_id or 0
+
+    def inserted(self):
+        """
+        Makes all processes add the subscriptions inserted since they last
+        looked, and only those.
+        """
+        del self.extent
+
+    def invalidate(self):
+        """
+        Makes all processes rebuild the index, after subscriptions have been
+        updated or deleted.
+        """
+        del self.subscriptions
+        del self.extent
+
+    def lookup(self, args):
+        """
+        Yields the notify-enabled subscriptions matching `args`, which maps
+        `repos`, `type`, `path` and `rev` to a value or a tuple of accepted
+        values. A missing `repos` matches all repositories.
+        """
+        index = self._current()
+        if 'repos' in args:
+            names = self.keys
+            rows = index.by_key
+        else:
+            names = self.keys[1:]
+            rows = index.by_location
+        candidates = [args.get(name, '') for name in names]
+        candidates = [value if isinstance(value, (tuple, list, set))
+                      else (value,) for value in candidates]
+        for key in product(*candidates):
+            for row in rows.get(key, ()):
+                yield Subscription._from_row(self.env, row)
+
+    def _current(self):
+        index = self.subscriptions
+        count, last_id = self.extent
+        if index.last_id < last_id:
+            with self._lock:
+                if index.last_id < last_id:
+                    index.add(self.env.db_query("""
+                        SELECT * FROM code_comments_subscriptions
+                        WHERE id>%s
+                        """, (index.last_id,)))
+        if index.count < count:
+            # Subscriptions have been committed out of the order of their
+            # ids, so some of them have been skipped
+            del self.subscriptions
+            index = self.subscriptions
+        return index
+
+
+class _IndexedSubscriptions(object):
+    """
+    The rows of the notify-enabled subscriptions, by `(repos, type, path,
+    rev)` and by `(type, path, rev)`, along with the number of rows seen
+    and their greatest id.
+    """
+
+    def __init__(self, rows):
+        self.by_key = {}
+        self.by_location = {}
+        self.count = 0
+        self.last_id = 0
+        self.add(rows)
+
+    def add(self, rows):
+        for row in rows:
+            row = tuple(row)
+            self.count += 1
+            self.last_id = max(self.last_id, row[0])
+            subscription = Subscription._from_row(None, row)
+            if not subscription.notify:
+                continue
+            key = tuple(getattr(subscription, name)
+                        for name in SubscriptionIndex.keys)
+            self.by_key.setdefault(key, []).append(row)
+            self.by_location.setdefault(key[1:], []).append(row)
+
 
 class SubscriptionJSONEncoder(json.JSONEncoder):
     """
@@ -354,40 +565,195 @@ class SubscriptionAdmin(Component):
     """
     implements(IAdminCommandProvider)
 
+    # Number of items processed per transaction while seeding
+    seed_chunk_size = 1000
+
+    # Prefix of the `system` table entries recording seeding progress
+    checkpoint_prefix = 'code_comments_seed:'
+
     # IAdminCommandProvider methods
 
     def get_admin_commands(self):
         yield ('subscription seed', '',
                """Seeds subscriptions for existing attachments, changesets,
                and comments.
+
+               Repositories are seeded in parallel. Progress is recorded as
+               it goes, so running the command again after an interruption
+               resumes where it stopped.
                """,
                None, self._do_seed)
 
     def _do_seed(self):
+        existing = set(tuple(row) for row in self.env.db_query("""
+            SELECT user, type, path, repos, rev
+            FROM code_comments_subscriptions
+            """))
+
         # Create a subscription for all existing attachments
-        for row in self.env.db_query("""
-                SELECT DISTINCT type, id FROM attachment
+        self._seed('attachments', None, self._attachment_items(), existing)
+
+        # Create a subscription for all existing revisions, one thread per
+        # repository
+        rm = RepositoryManager(self.env)
+        failures = []
+
+        def seed_repository(reponame):
+            try:
+                checkpoint = 'changesets:' + reponame
+                self._seed('changesets of %s' % (reponame or '(default)'),
+                           checkpoint,
+                           self._changeset_items(reponame,
+                                                 self._get_checkpoint(
+                                                     checkpoint)),
+                           existing)
+            except Exception, e:
+                failures.append(reponame)
+                printout("Seeding changesets of %s failed: %s"
+                         % (reponame or '(default)', exception_to_unicode(e)))
+
+        threads = [threading.Thread(target=seed_repository,
+                                    args=(repos.reponame,))
+                   for repos in rm.get_real_repositories()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Create a subscription for all existing comments
+        self._seed('comments', 'comments',
+                   self._comment_items(self._get_checkpoint('comments')),
+                   existing)
+
+        if failures:
+            printout("Run the command again to resume seeding.")
+        else:
+            self._clear_checkpoints()
+
+    def _seed(self, label, checkpoint, items, existing):
+        """
+        Inserts the subscription rows yielded as `(position, row)` by
+        `items` that don't exist yet. Rows are inserted in chunks, each
+        along with the position of its last item under the name
+        `checkpoint`. `row` may be `None` for items that don't lead to a
+        subscription.
+        """
+        processed = created = 0
+        rows = []
+        position = None
+        for position, row in items:
+            processed += 1
+            if row is not None and row[:5] not in existing:
+                existing.add(row[:5])
+                rows.append(row)
+            if processed % self.seed_chunk_size == 0:
+                created += self._insert(rows, checkpoint, position)
+                rows = []
+                printout("%s: %d processed, %d subscription(s) created"
+                         % (label, processed, created))
+        if processed:
+            created += self._insert(rows, checkpoint, position)
+        printout("%s: done, %d processed, %d subscription(s) created"
+                 % (label, processed, created))
+
+    def _insert(self, rows, checkpoint, position):
+        sql = """
+            INSERT INTO code_comments_subscriptions
+             (user, type, path, repos, rev, notify)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            """
+        try:
+            with self.env.db_transaction as db:
+                if rows:
+                    db.executemany(sql, rows)
+                    SubscriptionIndex(self.env).inserted()
+                if checkpoint:
+                    self._set_checkpoint(db, checkpoint, position)
+            return len(rows)
+        except self.env.db_exc.IntegrityError:
+            # Some subscriptions have been created concurrently, insert the
+            # others one by one
+            created = 0
+            for row in rows:
+                try:
+                    with self.env.db_transaction as db:
+                        db(sql, row)
+                    created += 1
+                except self.env.db_exc.IntegrityError:
+                    pass
+            with self.env.db_transaction as db:
+                if created:
+                    SubscriptionIndex(self.env).inserted()
+                if checkpoint:
+                    self._set_checkpoint(db, checkpoint, position)
+            return created
+
+    def _attachment_items(self):
+        for type, id, filename, author in self.env.db_query("""
+                SELECT type, id, filename, author FROM attachment
                 """):
-            for attachment in Attachment.select(self.env, row[0], row[1]):
-                Subscription.from_attachment(self.env, attachment)
+            path = "/{0}/{1}/{2}".format(type, id, filename)
+            yield None, (author, 'attachment', path, '', '', True)
+
+    def _changeset_items(self, reponame, start):
+        # Each thread needs its own repository instance
+        repos = RepositoryManager(self.env).get_repository(reponame)
+        if start:
+            rev = repos.next_rev(repos.normalize_rev(start))
+        else:
+            rev = repos.get_oldest_rev()
+        while rev:
+            try:
+                changeset = repos.get_changeset(rev)
+            except NoSuchChangeset:
+                yield rev, None
+            else:
+                yield rev, (changeset.author, 'changeset', '', reponame,
+                            unicode(changeset.rev), True)
+            rev = repos.next_rev(rev)
 
-        # Create a subscription for all existing revisions
+    def _comment_items(self, start):
         rm = RepositoryManager(self.env)
-        repos = rm.get_real_repositories()
-        for repo in repos:
-            _rev = repo.get_oldest_rev()
-            while _rev:
+        for id, author, type, path, revision in self.env.db_query("""
+                SELECT id, author, type, path, revision FROM code_comments
+                WHERE id>%s ORDER BY id
+                """, (int(start or 0),)):
+            row = None
+            if type == 'attachment':
+                row = (author, type, path.split(':')[1], '', '', True)
+            elif type in ('changeset', 'browser'):
+                reponame, repos, repos_path = rm.get_repository_by_path(path)
                 try:
-                    _cs = repo.get_changeset(_rev)
-                    Subscription.from_changeset(self.env, _cs)
+                    changeset = repos and repos.get_changeset(revision)
                 except NoSuchChangeset:
-                    pass
-                _rev = repo.next_rev(_rev)
+                    changeset = None
+                if changeset:
+                    row = (author, type,
+                           repos_path if type == 'browser' else '',
+                           reponame or '(default)', unicode(changeset.rev),
+                           True)
+            yield id, row
+
+    def _get_checkpoint(self, name):
+        for value, in self.env.db_query("""
+                SELECT value FROM system WHERE name=%s
+                """, (self.checkpoint_prefix + name,)):
+            return value
+
+    def _set_checkpoint(self, db, name, position):
+        name = self.checkpoint_prefix + name
+        position = unicode(position)
+        for _ in db("SELECT value FROM system WHERE name=%s", (name,)):
+            db("UPDATE system SET value=%s WHERE name=%s", (position, name))
+            break
+        else:
+            db("INSERT INTO system (name, value) VALUES (%s, %s)",
+               (name, position))
 
-        # Create a subscription for all existing comments
-        comments = Comments(None, self.env).all()
-        for comment in comments:
-            Subscription.from_comment(self.env, comment)
+    def _clear_checkpoints(self):
+        with self.env.db_transaction as db:
+            db("DELETE FROM system WHERE name " + db.like(),
+               (db.like_escape(self.checkpoint_prefix) + '%',))
 
 
 class SubscriptionListeners(Component):
@@ -437,6 +803,15 @@ class SubscriptionListeners(Component):
     def comment_created(self, comment):
         Subscription.from_comment(self.env, comment)
 
+    def comments_created(self, comments):
+        seen = set()
+        for comment in comments:
+            key = (comment.author, comment.type, comment.path,
+                   comment.revision)
+            if key not in seen:
+                seen.add(key)
+                Subscription.from_comment(self.env, comment)
+
 
 class SubscriptionModule(Component):
     implements(IRequestHandler, ITemplateStreamFilter)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from code_comments.tests import (
+    test_admin, test_cache, test_comment, test_db, test_macro,
+    test_notification, test_search, test_subscription,
+    test_ticket_event_listener, test_web)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(test_admin.test_suite())
+    suite.addTest(test_cache.test_suite())
+    suite.addTest(test_comment.test_suite())
+    suite.addTest(test_db.test_suite())
+    suite.addTest(test_macro.test_suite())
+    suite.addTest(test_notification.test_suite())
+    suite.addTest(test_search.test_suite())
+    suite.addTest(test_subscription.test_suite())
+    suite.addTest(test_ticket_event_listener.test_suite())
+    suite.addTest(test_web.test_suite())
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the time and memory it takes to load comments and read a column
+and to render the derived fields of a few of them.
+
+    python -m code_comments.tests.benchmark [rows]
+
+Rows default to 100000. An SQLite database file is used, as the in-memory
+database would count towards the memory used.
+"""
+
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from trac.test import Mock, MockPerm
+
+from code_comments.comment import CommentJSONEncoder
+from code_comments.comments import Comments
+from code_comments.tests.util import create_env, insert_comments
+
+
+def max_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def measure(name, function):
+    rss = max_rss_mib()
+    start = time.time()
+    result = function()
+    print '%-30s %8.2fs %+8.1f MiB max RSS' % (name, time.time() - start,
+                                              max_rss_mib() - rss)
+    return result
+
+
+def main(rows=100000):
+    directory = tempfile.mkdtemp()
+    try:
+        os.environ['TRAC_TEST_DB_URI'] = \
+            'sqlite:' + os.path.join(directory, 'trac.db')
+        env = create_env(path=directory)
+        insert_comments(env, [
+            ('Comment *%d* on [changeset:%d]' % (i, i % 100),
+             'repos/trunk/file%d.py' % (i % 500), i % 100, i % 1000,
+             'author%d' % (i % 50), 1000000 + i, 'browser')
+            for i in xrange(rows)])
+        req = Mock(href=env.href, abs_href=env.abs_href,
+                   authname='anonymous', perm=MockPerm(), args={})
+        comments = Comments(req, env)
+        print '%d comments' % rows
+        loaded = measure('load, read author',
+                         lambda: len(set(comment.author for comment
+                                         in comments.search({}))))
+        assert loaded == 50
+        measure('render and encode 100',
+                lambda: json.dumps(comments.search({}, per_page=100),
+                                   cls=CommentJSONEncoder))
+        env.shutdown()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from trac.admin.api import AdminCommandError
+
+from code_comments.comments import Comments, CommentsAdmin
+from code_comments.tests.util import create_env
+
+
+class CommentsAdminTestCase(unittest.TestCase):
+
+    columns = ['id', 'text', 'path', 'revision', 'line', 'author', 'time',
+               'type']
+
+    def setUp(self):
+        self.env = create_env()
+        self.admin = CommentsAdmin(self.env)
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'comments.ndjson')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        self.env.destroy_db()
+
+    def command(self, function, *args):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            function(*args)
+            return sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def rows(self):
+        return self.env.db_query("SELECT %s FROM code_comments ORDER BY id"
+                                 % ', '.join(self.columns))
+
+    def delete_all(self):
+        comments = Comments(None, self.env)
+        comments.delete_many(list(comments.iter_all()))
+        self.assertEqual([], self.rows())
+
+    def test_round_trip(self):
+        self.admin.import_comments(self.lines(['first', 'second', 'third']))
+        Comments(None, self.env).by_id(2).delete()
+        rows = self.rows()
+        self.command(self.admin._do_export, self.path)
+        self.delete_all()
+
+        self.assertIn('Imported 2 comment(s), skipped 0 invalid line(s).',
+                      self.command(self.admin._do_import, self.path))
+        # Stored as new comments, numbered by the database
+        self.assertEqual([row[1:] for row in rows],
+                         [row[1:] for row in self.rows()])
+        self.assertEqual(['third'], [comment.text for comment in
+                                     Comments(None, self.env)
+                                     .search({'q': 'third'})])
+
+    def test_round_trip_keep_ids(self):
+        self.admin.import_comments(self.lines(['first', 'second', 'third']))
+        Comments(None, self.env).by_id(2).delete()
+        rows = self.rows()
+        self.command(self.admin._do_export, '--no-html', self.path)
+        with open(self.path) as f:
+            self.assertNotIn('"html"', f.read())
+        self.delete_all()
+
+        self.command(self.admin._do_import, '--keep-ids', self.path)
+        self.assertEqual(rows, self.rows())
+        self.assertEqual([3], [comment.id for comment in
+                               Comments(None, self.env)
+                               .search({'q': 'third'})])
+        # New comments are numbered after the imported ones
+        id = Comments(None, self.env).create({
+            'text': 'fourth', 'author': 'alice',
+            'path': 'attachment:/ticket/1/fix.diff', 'revision': 0,
+            'line': 4, 'type': 'attachment'})
+        self.assertEqual(4, id)
+
+    def test_import_keep_ids_existing(self):
+        lines = self.lines(['first'])
+        self.admin.import_comments(lines)
+        exported = list(Comments(None, self.env).export(html=False))
+        self.assertRaises(AdminCommandError,
+                          self.admin.import_comments, exported, True)
+        self.assertEqual(1, len(self.rows()))
+
+    def test_import_skips_invalid_lines(self):
+        lines = self.lines(['first']) + ['not json\n', '[1]\n',
+                                         json.dumps({'text': 'x'}) + '\n']
+        output = self.command(self.admin.import_comments, lines)
+        self.assertIn('Line 2 skipped', output)
+        self.assertIn('Line 3 skipped: Not a JSON object', output)
+        self.assertIn('Line 4 skipped: Comment column(s) missing: author',
+                      output)
+        self.assertEqual(1, len(self.rows()))
+
+    def lines(self, texts):
+        return [json.dumps({'text': text, 'author': 'alice',
+                            'path': 'attachment:/ticket/1/fix.diff',
+                            'revision': 0, 'line': line, 'time': 1000 + line,
+                            'type': 'attachment'}) + '\n'
+                for line, text in enumerate(texts, 1)]
+
+    def test_import_failure_reports_lines(self):
+        self.env.db_transaction("""
+            CREATE TRIGGER reject_comment BEFORE INSERT ON code_comments
+            WHEN NEW.text='rejected'
+            BEGIN
+             SELECT RAISE(ABORT, 'rejected');
+            END
+            """)
+        self.admin.import_chunk_size = 2
+        lines = self.lines(['first', 'second', 'third', 'rejected'])
+        try:
+            self.admin.import_comments(lines)
+        except AdminCommandError, e:
+            self.assertIn('Importing lines 3 to 4 failed', unicode(e))
+        else:
+            self.fail("AdminCommandError not raised")
+        self.assertEqual(['first', 'second'],
+                         [comment.text for comment
+                          in Comments(None, self.env).search({}, 'ASC',
+                                                             order_by='id')])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CommentsAdminTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
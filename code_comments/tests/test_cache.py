@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from code_comments.cache import CommentHTMLCache
+from code_comments.tests.util import create_env
+
+
+class CommentHTMLCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+        self.cache = CommentHTMLCache(self.env)
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def stored(self):
+        return self.env.db_query("""
+            SELECT comment_id, html FROM code_comments_html
+            """)
+
+    def test_set_get(self):
+        self.cache.set(1, 'text', '<p>text</p>')
+        self.assertEqual('<p>text</p>', self.cache.get(1, 'text'))
+        self.assertEqual(None, self.cache.get(1, 'other text'))
+        self.assertEqual([(1, '<p>text</p>')], self.stored())
+
+    def test_set_replaces(self):
+        self.cache.set(1, 'text', '<p>text</p>')
+        self.cache.set(1, 'edited', '<p>edited</p>')
+        self.assertEqual([(1, '<p>edited</p>')], self.stored())
+
+    def test_set_concurrently(self):
+        self.cache.set(1, 'text', '<p>text</p>')
+        # Another request stores the comment between the deletion and the
+        # insertion
+        self.env.db_transaction("""
+            CREATE TRIGGER concurrent_set AFTER DELETE ON code_comments_html
+            BEGIN
+             INSERT INTO code_comments_html
+             VALUES (OLD.comment_id, OLD.text_hash, OLD.generation,
+                     'concurrent');
+            END
+            """)
+        self.cache.set(1, 'text', '<p>text</p>')
+        self.assertEqual('<p>text</p>', self.cache.get(1, 'text'))
+        # Rolled back, leaving what was there before
+        self.assertEqual([(1, '<p>text</p>')], self.stored())
+
+    def test_invalidate(self):
+        self.cache.set(1, 'text', '<p>text</p>')
+        self.cache.set(2, 'text', '<p>text</p>')
+        self.cache.invalidate(1)
+        self.assertEqual([(2, '<p>text</p>')], self.stored())
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CommentHTMLCacheTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+from trac.db.util import IterableCursor
+from trac.test import Mock
+
+import code_comments.comment
+from code_comments.comment import Comment, CommentJSONEncoder
+from code_comments.comments import Comments
+from code_comments.tests.util import create_env, insert_comments
+
+
+class LazyCommentTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+        insert_comments(self.env, [
+            ('text %d' % i, 'repos/trunk/a.py', 3, i, 'author%d' % (i % 3),
+             1000 + i, 'browser') for i in range(1, 11)])
+        self.rendered = []
+        self._format_to_html = code_comments.comment.format_to_html
+
+        def format_to_html(req, env, text):
+            self.rendered.append(text)
+            return self._format_to_html(req, env, text)
+        code_comments.comment.format_to_html = format_to_html
+
+    def tearDown(self):
+        code_comments.comment.format_to_html = self._format_to_html
+        self.env.destroy_db()
+
+    def test_slots(self):
+        comment = Comments(None, self.env).by_id(1)
+        self.assertFalse(hasattr(comment, '__dict__'))
+
+    def test_columns_do_not_render(self):
+        comments = Comments(None, self.env).all()
+        self.assertEqual(10, len(comments))
+        self.assertEqual(set(['author0', 'author1', 'author2']),
+                         set(comment.author for comment in comments))
+        self.assertEqual([], self.rendered)
+
+    def test_html_is_memoized(self):
+        comment = Comments(None, self.env).by_id(1)
+        html = comment.html
+        self.assertEqual(html, comment.html)
+        self.assertEqual(['text 1'], self.rendered)
+
+    def test_html_is_cached(self):
+        Comments(None, self.env).by_id(1).html
+        Comments(None, self.env).by_id(1).html
+        self.assertEqual(['text 1'], self.rendered)
+
+    def test_html_cache_queries(self):
+        queries = []
+        execute = IterableCursor.execute
+        executemany = IterableCursor.executemany
+
+        def record(method):
+            def wrapper(cursor, sql, *args):
+                if 'code_comments_html' in sql:
+                    queries.append(sql.split()[0])
+                return method(cursor, sql, *args)
+            return wrapper
+        IterableCursor.execute = record(execute)
+        IterableCursor.executemany = record(executemany)
+        try:
+            for comment in Comments(None, self.env).all():
+                comment.html
+            # One lookup, then a single transaction storing them all
+            self.assertEqual(['SELECT', 'DELETE', 'INSERT'], queries)
+            self.assertEqual(10, len(self.rendered))
+            del queries[:]
+            for comment in Comments(None, self.env).all():
+                comment.html
+            self.assertEqual([], queries)
+            self.assertEqual(10, len(self.rendered))
+        finally:
+            IterableCursor.execute = execute
+            IterableCursor.executemany = executemany
+
+    def test_attachment_info(self):
+        comment = Comment(None, self.env, {
+            'id': 1, 'type': 'attachment', 'text': 'text', 'author': 'a',
+            'path': 'attachment:/ticket/12/some/file.diff', 'line': 0})
+        self.assertEqual(12, comment.attachment_ticket)
+        self.assertEqual('some/file.diff', comment.attachment_filename)
+        self.assertTrue(comment.is_comment_to_attachment)
+        self.assertFalse(comment.is_comment_to_file)
+
+    def test_json(self):
+        req = Mock(href=self.env.href, abs_href=self.env.abs_href)
+        comment = Comments(req, self.env).by_id(1)
+        data = json.loads(json.dumps(comment, cls=CommentJSONEncoder))
+        # The attachment info is None, which isn't serialized
+        expected = set(Comment.json_fields) - set(['attachment_ticket',
+                                                   'attachment_filename'])
+        expected.update(['formatted_date', 'permalink'])
+        self.assertEqual(expected, set(data))
+        self.assertEqual('author1', data['author'])
+        self.assertEqual('/trac.cgi/browser/repos/trunk/a.py'
+                         '?codecomment=1&rev=3#L1', data['permalink'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LazyCommentTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import re
+import unittest
+
+from trac.db.api import DatabaseManager
+from trac.db.schema import Column, Index, Table
+from trac.test import EnvironmentStub
+
+from code_comments import db
+from code_comments.comments import Comments
+from code_comments.tests.util import create_env, insert_comments
+
+
+class RecordingComments(Comments):
+    """
+    Records the queries instead of running them.
+    """
+
+    def __init__(self, req, env):
+        Comments.__init__(self, req, env)
+        self.queries = []
+
+    def select(self, *query):
+        self.queries.append(query)
+        return []
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    """
+    Makes sure that the hottest comment queries are served by indexes on
+    SQLite, and don't fall back to scanning the table or sorting it.
+    """
+
+    def setUp(self):
+        self.env = create_env()
+        self.comments = RecordingComments(None, self.env)
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def _plan(self):
+        self.assertEqual(1, len(self.comments.queries))
+        sql, args = self.comments.queries.pop()
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, args)
+            # The last column is the description of the step
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertNoTableScan(self, plan):
+        for step in plan:
+            if re.match(r'SCAN (TABLE )?code_comments\b', step) \
+                    and ' USING ' not in step:
+                self.fail("Table scan in query plan: %r" % plan)
+
+    def assertNoSort(self, plan):
+        for step in plan:
+            if 'TEMP B-TREE' in step:
+                self.fail("Sort in query plan: %r" % plan)
+
+    def assertUsesIndex(self, index, plan):
+        if not any(index in step for step in plan):
+            self.fail("%s not used by query plan: %r" % (index, plan))
+
+    def test_page_comments(self):
+        # `CommentsList.fetchPageComments`
+        self.comments.search({'type': 'browser', 'path': 'repos/trunk/a.py',
+                              'revision': 3, 'line': 0})
+        plan = self._plan()
+        self.assertNoTableScan(plan)
+        self.assertUsesIndex('code_comments_type_path_revision_line_idx',
+                             plan)
+
+    def test_line_comments(self):
+        # `CommentsList.fetchLineComments`
+        self.comments.search_page({'type': 'browser',
+                                   'path': 'repos/trunk/a.py',
+                                   'revision': 3, 'line__gt': 0})
+        plan = self._plan()
+        self.assertNoTableScan(plan)
+        self.assertUsesIndex('code_comments_type_path_revision_line_idx',
+                             plan)
+
+    def test_line_range(self):
+        self.comments.search_page({'type': 'browser',
+                                   'path': 'repos/trunk/a.py',
+                                   'revision': 3, 'line__gt': 199,
+                                   'line__lt': 401})
+        plan = self._plan()
+        self.assertNoTableScan(plan)
+        self.assertUsesIndex('code_comments_type_path_revision_line_idx',
+                             plan)
+
+    def test_comment_thread(self):
+        # `CodeCommentNotifyEmail._get_comment_thread`
+        self.comments.search({'type': 'changeset', 'path': '',
+                              'revision': 3, 'line': 12}, order_by='id')
+        plan = self._plan()
+        self.assertNoTableScan(plan)
+        self.assertNoSort(plan)
+        self.assertUsesIndex('code_comments_type_path_revision_line_idx',
+                             plan)
+
+    def test_list_by_time(self):
+        # The list page, newest first
+        self.comments.search_page({}, order='DESC', per_page=50)
+        plan = self._plan()
+        self.assertNoSort(plan)
+        self.assertUsesIndex('code_comments_time_id_idx', plan)
+
+    def test_list_by_time_next_page(self):
+        self.comments.search_page({}, order='DESC', per_page=50,
+                                  cursor=self._cursor('time', 'DESC'))
+        plan = self._plan()
+        self.assertNoTableScan(plan)
+        self.assertNoSort(plan)
+        self.assertUsesIndex('code_comments_time_id_idx', plan)
+
+    def _cursor(self, order_by, order):
+        comment = Comments(None, self.env).comment_from_row(
+            [5, 1, 'text', '', 3, 0, 'author', 1000, 'changeset'])
+        return self.comments.encode_cursor(comment, order_by, order, 'next')
+
+
+class UpgradeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(default_data=True,
+                                   enable=['trac.*', 'code_comments.*'])
+        self.dbm = DatabaseManager(self.env)
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def test_upgrade_from_3(self):
+        # The tables as of version 3
+        self.dbm.create_tables([
+            Table('code_comments', key=('id', 'version'))[
+                Column('id', auto_increment=True),
+                Column('version', type='int'),
+                Column('text'),
+                Column('path'),
+                Column('revision', type='int'),
+                Column('line', type='int'),
+                Column('author'),
+                Column('time', type='int'),
+                Column('type'),
+                Index(['path']),
+                Index(['author']),
+            ],
+            Table('code_comments_subscriptions',
+                  key=('id', 'user', 'type', 'path', 'repos', 'rev'))[
+                Column('id', auto_increment=True),
+                Column('user'),
+                Column('type'),
+                Column('path'),
+                Column('repos'),
+                Column('rev'),
+                Column('notify', type='bool'),
+                Index(['user']),
+                Index(['path']),
+            ],
+        ])
+        self.dbm.set_database_version(3, db.db_version_key)
+        insert_comments(self.env, [('Some words', 'repos/trunk/a.py', 3, 1,
+                                    'alice', 1000, 'browser')])
+        setup = db.CodeCommentsSetup(self.env)
+
+        self.assertTrue(setup.environment_needs_upgrade())
+        setup.upgrade_environment()
+        self.assertFalse(setup.environment_needs_upgrade())
+        self.assertEqual(
+            [column.name for column
+             in db.schema['code_comments_notifications'].columns],
+            self.dbm.get_column_names('code_comments_notifications'))
+        self.assertEqual(1, len(Comments(None, self.env)
+                                .search({'q': 'words'})))
+
+    def test_upgrade_from_9_drops_duplicate_subscriptions(self):
+        table = db.schema['code_comments_subscriptions']
+        outbox = db.schema['code_comments_notifications']
+        self.dbm.create_tables([
+            Table(table.name, key=table.key)[
+                list(table.columns) +
+                [index for index in table.indices if not index.unique]],
+            Table(outbox.name, key=outbox.key)[
+                [column for column in outbox.columns
+                 if column.name != 'delivered_to'] + list(outbox.indices)],
+        ])
+        self.dbm.set_database_version(9, db.db_version_key)
+        with self.env.db_transaction as db_:
+            db_.executemany("""
+                INSERT INTO code_comments_subscriptions
+                 (user, type, path, repos, rev, notify)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                """, [('alice', 'changeset', '', 'repos', '3', 1),
+                      ('alice', 'changeset', '', 'repos', '3', 0),
+                      ('bob', 'changeset', '', 'repos', '3', 1),
+                      ('alice', 'changeset', '', 'repos', '4', 1)])
+
+        db.CodeCommentsSetup(self.env).upgrade_environment()
+        self.assertEqual(
+            [(1, 'alice', '3'), (3, 'bob', '3'), (4, 'alice', '4')],
+            self.env.db_query("""
+                SELECT id, user, rev FROM code_comments_subscriptions
+                ORDER BY id
+                """))
+        self.assertRaises(self.env.db_exc.IntegrityError,
+                          self.env.db_transaction, """
+            INSERT INTO code_comments_subscriptions
+             (user, type, path, repos, rev, notify)
+            VALUES ('bob', 'changeset', '', 'repos', '3', 1)
+            """)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(QueryPlanTestCase))
+    suite.addTest(unittest.makeSuite(UpgradeTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from trac.web.chrome import web_context
+from trac.test import MockRequest
+from trac.wiki.formatter import format_to_html
+
+from code_comments.comments import Comments
+from code_comments.tests.util import create_env
+
+
+class CodeCommentLinkMacroTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+        self.id = Comments(None, self.env).create({
+            'text': 'Some words', 'author': 'alice',
+            'path': 'attachment:/ticket/1/fix.diff', 'revision': 0,
+            'line': 3, 'type': 'attachment'})
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def format(self, text):
+        req = MockRequest(self.env)
+        return unicode(format_to_html(self.env, web_context(req), text))
+
+    def test_link(self):
+        html = self.format('See [[CodeCommentLink(%d)]].' % self.id)
+        self.assertIn('?codecomment=%d#L3">#%d: fix.diff</a>'
+                      % (self.id, self.id), html)
+
+    def test_unknown_id(self):
+        self.assertEqual('<p>\nSee .\n</p>\n',
+                         self.format('See [[CodeCommentLink(%d)]].'
+                                     % (self.id + 1)))
+
+    def test_invalid_id(self):
+        self.assertEqual('<p>\nSee .\n</p>\n',
+                         self.format('See [[CodeCommentLink(x)]].'))
+
+    def test_no_argument(self):
+        self.assertEqual('<p>\nSee .\n</p>\n',
+                         self.format('See [[CodeCommentLink]].'))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(CodeCommentLinkMacroTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+
+import asyncore
+import os
+import smtpd
+import threading
+import unittest
+
+from trac.env import env_cache
+
+from code_comments.comments import Comments
+from code_comments.notification import (
+    CodeCommentNotificationQueue, CodeCommentNotifyEmail)
+from code_comments.subscription import SubscriptionIndex
+from code_comments.tests.util import create_env
+
+
+class SMTPServer(smtpd.SMTPServer):
+    """
+    Local SMTP stand-in, keeping the messages it receives.
+    """
+
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.messages = []
+        # Addresses whose messages are refused
+        self.rejected = set()
+        self.thread = threading.Thread(target=asyncore.loop,
+                                       kwargs={'timeout': 0.05})
+        self.thread.daemon = True
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        if self.rejected.intersection(rcpttos):
+            return '550 Mailbox unavailable'
+        self.messages.append((sorted(rcpttos), data))
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        asyncore.close_all()
+        self.thread.join()
+
+    def recipients(self):
+        return [rcpttos for rcpttos, data in self.messages]
+
+
+class NotificationTestCase(unittest.TestCase):
+
+    path = 'attachment:/ticket/1/fix.diff'
+
+    def setUp(self):
+        self.smtp = SMTPServer()
+        self.smtp.start()
+        self.env = create_env()
+        for name, value in [('smtp_enabled', 'true'),
+                            ('smtp_server', '127.0.0.1'),
+                            ('smtp_port', str(self.smtp.port)),
+                            ('smtp_from', 'trac@example.org'),
+                            ('smtp_default_domain', 'example.org')]:
+            self.env.config.set('notification', name, value)
+        self.env.config.set('code_comments', 'notification_worker_threads',
+                            '0')
+        self.queue = CodeCommentNotificationQueue(self.env)
+        self.comments = Comments(None, self.env)
+
+    def tearDown(self):
+        self.smtp.stop()
+        self.env.destroy_db()
+
+    def create(self, author, line=3, text=None):
+        return self.comments.create({
+            'text': text or 'Comment by %s' % author, 'author': author,
+            'path': self.path, 'revision': 0, 'line': line,
+            'type': 'attachment'})
+
+    def outbox(self):
+        return self.env.db_query("""
+            SELECT comment_id, attempts, last_error
+            FROM code_comments_notifications ORDER BY id
+            """)
+
+    def wait_for(self, count):
+        # The server handles messages in its own thread
+        for i in xrange(100):
+            if len(self.smtp.messages) >= count:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(count, len(self.smtp.messages))
+
+    def make_due(self):
+        # Instead of waiting for the retry delay
+        self.env.db_transaction("""
+            UPDATE code_comments_notifications SET next_attempt=0
+            """)
+
+    def break_smtp(self):
+        # Nothing listens on the port of a stopped server
+        self.smtp.stop()
+
+    def repair_smtp(self):
+        self.smtp = SMTPServer()
+        self.smtp.start()
+        self.env.config.set('notification', 'smtp_port', str(self.smtp.port))
+
+    def test_create_queues(self):
+        id = self.create('alice')
+        self.assertEqual([(id, 0, '')], self.outbox())
+        self.assertEqual([], self.smtp.messages)
+
+    def test_deliver_reply(self):
+        self.create('alice')
+        # Nobody to notify of the first comment
+        self.assertEqual(1, self.queue.deliver())
+        self.create('bob')
+        self.assertEqual(1, self.queue.deliver())
+        self.wait_for(1)
+        self.assertEqual([['alice@example.org']], self.smtp.recipients())
+        self.assertIn('Comment by bob', self.smtp.messages[0][1])
+        self.assertEqual([], self.outbox())
+
+    def test_reply_to_previous_author(self):
+        self.create('alice')
+        id = self.create('bob')
+        self.create('bob')
+        self.env.db_transaction("""
+            UPDATE code_comments_subscriptions SET notify=0
+            WHERE user='alice'
+            """)
+        SubscriptionIndex(self.env).invalidate()
+        # The later reply by bob is already there when the first is sent
+        notifier = CodeCommentNotifyEmail(self.env)
+        self.assertEqual((set(['alice']), set()),
+                         notifier.get_recipients(self.comments.by_id(id)))
+
+    def test_worker_stops_with_environment(self):
+        self.env.config.set('code_comments', 'notification_poll_interval',
+                            '0')
+        path = os.path.normcase(os.path.normpath(self.env.path))
+        env_cache[path] = self.env
+        try:
+            worker = threading.Thread(target=self.queue._run_worker)
+            worker.daemon = True
+            worker.start()
+            threading.Event().wait(0.1)
+            self.assertTrue(worker.is_alive())
+        finally:
+            # As open_environment() does when trac.ini changes
+            del env_cache[path]
+        worker.join(1)
+        self.assertFalse(worker.is_alive())
+
+    def test_retry(self):
+        self.create('alice')
+        self.queue.deliver()
+        id = self.create('bob')
+        self.break_smtp()
+        self.assertEqual(1, self.queue.deliver())
+        (comment_id, attempts, error), = self.outbox()
+        self.assertEqual((id, 1), (comment_id, attempts))
+        self.assertTrue(error)
+
+        self.repair_smtp()
+        # Not due yet
+        self.assertEqual(0, self.queue.deliver())
+        self.make_due()
+        self.assertEqual(1, self.queue.deliver())
+        self.wait_for(1)
+        self.assertEqual([['alice@example.org']], self.smtp.recipients())
+        self.assertEqual([], self.outbox())
+
+    def test_give_up(self):
+        self.env.config.set('code_comments', 'notification_max_attempts', '2')
+        self.create('alice')
+        self.queue.deliver()
+        self.create('bob')
+        self.break_smtp()
+        self.assertEqual(1, self.queue.deliver())
+        self.make_due()
+        self.assertEqual(1, self.queue.deliver())
+        self.make_due()
+        self.assertEqual(0, self.queue.deliver())
+        self.assertEqual([2], [attempts for comment_id, attempts, error
+                               in self.outbox()])
+
+    def test_batch(self):
+        self.create('alice', line=3)
+        self.create('alice', line=4)
+        self.queue.deliver()
+        self.comments.create_many([
+            {'text': 'First reply', 'author': 'bob', 'path': self.path,
+             'revision': 0, 'line': 3, 'type': 'attachment'},
+            {'text': 'Second reply', 'author': 'bob', 'path': self.path,
+             'revision': 0, 'line': 4, 'type': 'attachment'},
+        ])
+        self.assertEqual(2, self.queue.deliver())
+        self.wait_for(1)
+        self.assertEqual([['alice@example.org']], self.smtp.recipients())
+        self.assertIn('First reply', self.smtp.messages[0][1])
+        self.assertIn('Second reply', self.smtp.messages[0][1])
+
+    def test_retry_failed_recipients(self):
+        self.create('alice', line=3)
+        self.queue.deliver()
+        self.create('bob', line=4)
+        self.queue.deliver()
+        self.wait_for(1)
+        del self.smtp.messages[:]
+        self.comments.create_many([
+            {'text': 'First reply', 'author': 'carol', 'path': self.path,
+             'revision': 0, 'line': 3, 'type': 'attachment'},
+            {'text': 'Second reply', 'author': 'carol', 'path': self.path,
+             'revision': 0, 'line': 4, 'type': 'attachment'},
+        ])
+        self.smtp.rejected.add('bob@example.org')
+        self.assertEqual(2, self.queue.deliver())
+        self.wait_for(1)
+        self.assertEqual([['alice@example.org']], self.smtp.recipients())
+        self.assertEqual([1, 1], [attempts for comment_id, attempts, error
+                                  in self.outbox()])
+
+        self.smtp.rejected.clear()
+        self.make_due()
+        self.assertEqual(2, self.queue.deliver())
+        self.wait_for(2)
+        # Alice is not sent the digest again
+        self.assertEqual([['alice@example.org'], ['bob@example.org']],
+                         self.smtp.recipients())
+        self.assertIn('First reply', self.smtp.messages[1][1])
+        self.assertIn('Second reply', self.smtp.messages[1][1])
+        self.assertEqual([], self.outbox())
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(NotificationTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
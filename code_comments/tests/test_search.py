@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from code_comments.comments import Comments
+from code_comments.search import CommentSearchIndex
+from code_comments.tests.util import create_env
+
+
+class SearchIndexTestMixin(object):
+
+    texts = ['Apple and banana', 'Apple, apple and banana', 'Cherry']
+
+    def setUp(self):
+        self.env = create_env()
+        self.index = CommentSearchIndex(self.env)
+        self.setUpIndex()
+        self.comments = Comments(None, self.env)
+        self.ids = [self.comments.create({
+            'text': text, 'author': 'alice',
+            'path': 'attachment:/ticket/1/fix.diff', 'revision': 0,
+            'line': line, 'type': 'attachment'})
+            for line, text in enumerate(self.texts, 1)]
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def matching(self, query):
+        return sorted(comment.id for comment
+                      in self.comments.search({'q': query}))
+
+    def test_search(self):
+        first, second, third = self.ids
+        self.assertEqual([second, first], self.index.search('apple', 10))
+        self.assertEqual([second], self.index.search('apple', 1))
+        self.assertEqual([third], self.index.search('CHERRY', 10))
+        self.assertEqual([], self.index.search('apple cherry', 10))
+
+    def test_condition(self):
+        first, second, third = self.ids
+        self.assertEqual([first, second], self.matching('banana apple'))
+        self.assertEqual([], self.matching('apple cherry'))
+        # Too short to be indexed
+        self.assertEqual([], self.matching('a'))
+
+    def test_operator_words(self):
+        first, second, third = self.ids
+        self.assertEqual([first, second], self.matching('and'))
+
+    def test_delete(self):
+        first, second, third = self.ids
+        self.comments.by_id(first).delete()
+        self.assertEqual([second], self.index.search('apple', 10))
+        self.comments.delete_many([self.comments.by_id(second)])
+        self.assertEqual([], self.index.search('apple', 10))
+        self.assertEqual([third], self.index.search('cherry', 10))
+
+    def test_rebuild(self):
+        first, second, third = self.ids
+        self.index.remove(self.ids)
+        self.assertEqual([], self.matching('apple'))
+        self.assertEqual(3, self.index.rebuild())
+        self.assertEqual([first, second], self.matching('apple'))
+        self.assertEqual([third], self.matching('cherry'))
+        # Rebuilding again doesn't index the comments twice
+        self.assertEqual(3, self.index.rebuild())
+        self.assertEqual([second, first], self.index.search('apple', 10))
+
+
+class FTSSearchIndexTestCase(SearchIndexTestMixin, unittest.TestCase):
+
+    def setUpIndex(self):
+        if not self.index.use_fts:
+            self.skipTest("SQLite FTS5 is not available")
+
+
+class TermsSearchIndexTestCase(SearchIndexTestMixin, unittest.TestCase):
+
+    def setUpIndex(self):
+        # As on databases other than SQLite
+        self.env.db_transaction("DROP TABLE IF EXISTS %s"
+                                % self.index.fts_table)
+        self.index._use_fts = None
+        self.assertFalse(self.index.use_fts)
+
+    def test_terms(self):
+        first, second, third = self.ids
+        self.assertEqual([('and', 1), ('apple', 2), ('banana', 1)],
+                         sorted(self.env.db_query("""
+                            SELECT term, count FROM code_comments_terms
+                            WHERE comment_id=%s
+                            """, (second,))))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(FTSSearchIndexTestCase))
+    suite.addTest(unittest.makeSuite(TermsSearchIndexTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from code_comments.comment import Comment
+from code_comments.subscription import (
+    Subscription, SubscriptionAdmin, SubscriptionIndex, path_ancestors)
+from code_comments.tests.util import create_env
+
+
+class SubscriptionIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+        self.index = SubscriptionIndex(self.env)
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def subscribe(self, user, type='changeset', path='', repos='repos',
+                  rev='3', notify=True):
+        subscription = Subscription(self.env)
+        subscription.user = user
+        subscription.type = type
+        subscription.path = path
+        subscription.repos = repos
+        subscription.rev = rev
+        subscription.notify = notify
+        subscription.insert()
+        return subscription
+
+    def users(self, **args):
+        return sorted(subscription.user
+                      for subscription in self.index.lookup(args))
+
+    def test_lookup(self):
+        self.subscribe('alice')
+        self.subscribe('bob', repos='other')
+        self.subscribe('carol', notify=False)
+        self.subscribe('dave', type='browser', path='trunk/a.py')
+        self.assertEqual(['alice'], self.users(type='changeset', path='',
+                                                repos='repos', rev='3'))
+        self.assertEqual(['alice', 'dave'],
+                         self.users(type=('changeset', 'browser'),
+                                    path=('', 'trunk/a.py'),
+                                    repos='repos', rev='3'))
+
+    def test_lookup_all_repositories(self):
+        self.subscribe('alice')
+        self.subscribe('bob', repos='other')
+        self.subscribe('carol', rev='4')
+        self.assertEqual(['alice', 'bob'],
+                         self.users(type='changeset', path='', rev='3'))
+
+    def test_insert_adds_to_index(self):
+        self.subscribe('alice')
+        self.assertEqual(['alice'], self.users(type='changeset', rev='3'))
+        subscriptions = self.index.subscriptions
+        self.subscribe('bob', repos='other')
+        self.subscribe('carol', notify=False)
+        self.assertEqual(['alice', 'bob'],
+                         self.users(type='changeset', rev='3'))
+        # Updated in place rather than rebuilt
+        self.assertIs(subscriptions, self.index.subscriptions)
+
+    def test_update_rebuilds_index(self):
+        subscription = self.subscribe('alice')
+        self.subscribe('bob')
+        self.assertEqual(['alice', 'bob'],
+                         self.users(type='changeset', rev='3'))
+        subscription.notify = False
+        subscription.update()
+        self.assertEqual(['bob'], self.users(type='changeset', rev='3'))
+        subscription.delete()
+        self.assertEqual(['bob'], self.users(type='changeset', rev='3'))
+
+    def test_insert_out_of_order(self):
+        self.env.db_transaction("""
+            INSERT INTO code_comments_subscriptions
+             (id, user, type, path, repos, rev, notify)
+            VALUES (5, 'alice', 'changeset', '', 'repos', '3', 1)
+            """)
+        self.assertEqual(['alice'], self.users(type='changeset', rev='3'))
+        # Committed after the subscription with a greater id
+        with self.env.db_transaction as db:
+            db("""
+                INSERT INTO code_comments_subscriptions
+                 (id, user, type, path, repos, rev, notify)
+                VALUES (3, 'bob', 'changeset', '', 'repos', '3', 1)
+                """)
+            self.index.inserted()
+        self.assertEqual(['alice', 'bob'],
+                         self.users(type='changeset', rev='3'))
+
+
+class DirectorySubscriptionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+        for user, path in [('alice', 'trunk/src'), ('bob', ''),
+                           ('carol', 'trunk/srcs'), ('dave', 'trunk/other'),
+                           ('erin', 'trunk/src/sub'), ('frank', 'src')]:
+            Subscription.from_dict(self.env, {
+                'user': user, 'type': 'directory', 'path': path,
+                'repos': '', 'rev': '', 'notify': True})
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def users(self, path, notify):
+        comment = Comment(None, self.env, {
+            'id': 1, 'text': 'text', 'author': 'zoe', 'type': 'browser',
+            'path': path, 'revision': 3, 'line': 1})
+        return sorted(subscription.user for subscription
+                      in Subscription.for_comment(self.env, comment, notify))
+
+    def test_path_ancestors(self):
+        self.assertEqual(['', 'trunk', 'trunk/src'],
+                         path_ancestors('trunk/src/a.py'))
+        self.assertEqual([''], path_ancestors('/a.py'))
+
+    def test_for_comment(self):
+        # Both from the subscription index and from the database
+        for notify in (True, None):
+            self.assertEqual(['alice', 'bob'],
+                             self.users('trunk/src/a.py', notify))
+            self.assertEqual(['alice', 'bob', 'erin'],
+                             self.users('trunk/src/sub/b.py', notify))
+            self.assertEqual(['bob'], self.users('trunk/a.py', notify))
+
+
+class SubscriptionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+        self.data = {'user': 'alice', 'type': 'changeset', 'path': '',
+                     'repos': 'repos', 'rev': '3', 'notify': True}
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def test_from_dict(self):
+        subscription = Subscription.from_dict(self.env, dict(self.data))
+        self.assertTrue(subscription.id)
+        self.assertEqual(subscription.id,
+                         Subscription.from_dict(self.env,
+                                                dict(self.data)).id)
+
+    def test_duplicate(self):
+        Subscription.from_dict(self.env, dict(self.data))
+        subscription = Subscription(self.env, dict(self.data))
+        self.assertFalse(subscription.insert())
+        self.assertEqual(0, subscription.id)
+        self.assertEqual(1, len(list(Subscription.select(self.env))))
+
+    def test_from_dict_created_concurrently(self):
+        existing = Subscription.from_dict(self.env, dict(self.data))
+        select = Subscription.__dict__['select']
+
+        def select_nothing_once(cls, env, args={}, notify=None):
+            # As if the subscription was inserted right after the lookup
+            cls.select = select
+            return iter([])
+        Subscription.select = classmethod(select_nothing_once)
+        try:
+            subscription = Subscription.from_dict(self.env, dict(self.data))
+        finally:
+            Subscription.select = select
+        self.assertEqual(existing.id, subscription.id)
+
+    def test_seed_insert_skips_duplicates(self):
+        # Created after seeding took the list of existing subscriptions
+        Subscription.from_dict(self.env, dict(self.data))
+        rows = [('alice', 'changeset', '', 'repos', '3', True),
+                ('alice', 'changeset', '', 'repos', '4', True)]
+        self.assertEqual(1, SubscriptionAdmin(self.env)._insert(rows, None,
+                                                                None))
+        self.assertEqual(['3', '4'], sorted(
+            subscription.rev
+            for subscription in Subscription.select(self.env)))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SubscriptionIndexTestCase))
+    suite.addTest(unittest.makeSuite(DirectorySubscriptionTestCase))
+    suite.addTest(unittest.makeSuite(SubscriptionTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from datetime import datetime, timedelta
+
+from trac.ticket.model import Ticket
+from trac.util.datefmt import utc
+
+from code_comments.tests.util import create_env
+from code_comments.ticket_event_listener import UpdateTicketCodeComments
+
+
+def links(*ids):
+    return ' '.join('[[CodeCommentLink(%d)]]' % id for id in ids)
+
+
+class TicketRelationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+        self.when = datetime(2020, 1, 1, tzinfo=utc)
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def tick(self):
+        # Changes of a ticket are keyed by time
+        self.when += timedelta(seconds=1)
+        return self.when
+
+    def create(self, description):
+        ticket = Ticket(self.env)
+        ticket.populate({'summary': 'Review', 'reporter': 'alice',
+                         'status': 'new', 'description': description})
+        ticket.insert(when=self.tick())
+        return ticket
+
+    def comment(self, ticket, text):
+        when = self.tick()
+        ticket.save_changes('alice', text, when=when)
+        return when
+
+    def edit_description(self, ticket, text):
+        ticket['description'] = text
+        ticket.save_changes('alice', '', when=self.tick())
+
+    def relations(self):
+        return sorted(self.env.db_query("""
+            SELECT ticket, comment_id FROM code_comment_ticket_relations
+            """))
+
+    def relation_fields(self):
+        return sorted(self.env.db_query("""
+            SELECT ticket, value FROM ticket_custom
+            WHERE name='code_comment_relation'
+            """))
+
+    def assertRelations(self, ticket, comment_ids):
+        self.assertEqual([(ticket.id, id) for id in comment_ids],
+                         self.relations())
+        self.assertEqual([(ticket.id, ','.join(map(str, comment_ids)))],
+                         self.relation_fields())
+
+    def test_created(self):
+        ticket = self.create('See ' + links(1, 2))
+        self.assertRelations(ticket, [1, 2])
+
+    def test_description_edited(self):
+        ticket = self.create(links(1, 2))
+        self.edit_description(ticket, links(1, 3))
+        self.assertRelations(ticket, [1, 3])
+
+    def test_comment_added(self):
+        ticket = self.create(links(1))
+        self.comment(ticket, links(2))
+        self.assertRelations(ticket, [1, 2])
+
+    def test_comment_edited(self):
+        ticket = self.create('')
+        cdate = self.comment(ticket, links(1, 2))
+        ticket.modify_comment(cdate, 'alice', links(2), when=self.tick())
+        self.assertRelations(ticket, [2])
+        ticket.modify_comment(cdate, 'alice', links(2, 3), when=self.tick())
+        self.assertRelations(ticket, [2, 3])
+
+    def test_comment_deleted(self):
+        ticket = self.create(links(1))
+        self.comment(ticket, links(2))
+        self.comment(ticket, 'Nothing')
+        ticket.delete_change(cnum=1)
+        self.assertRelations(ticket, [1])
+
+    def test_still_linked_elsewhere(self):
+        ticket = self.create(links(1, 2))
+        self.comment(ticket, links(1))
+        self.edit_description(ticket, links(2))
+        # Still linked from the comment
+        self.assertRelations(ticket, [1, 2])
+        ticket = Ticket(self.env, ticket.id)
+        ticket.delete_change(cnum=1)
+        self.assertRelations(ticket, [2])
+
+    def test_description_change_deleted(self):
+        ticket = self.create(links(1))
+        self.edit_description(ticket, links(2))
+        ticket.delete_change(cnum=1)
+        self.assertRelations(ticket, [1])
+
+    def test_ticket_deleted(self):
+        ticket = self.create(links(1))
+        ticket.delete()
+        self.assertEqual([], self.relations())
+
+    def test_rebuild(self):
+        first = self.create(links(1, 2))
+        self.comment(first, links(3))
+        self.edit_description(first, links(2))
+        second = self.create('')
+        self.comment(second, links(1))
+        self.comment(second, 'Nothing')
+        second.delete_change(cnum=1)
+        third = self.create(links(4))
+        relations = self.relations()
+        relation_fields = self.relation_fields()
+        self.assertEqual([(first.id, 2), (first.id, 3), (third.id, 4)],
+                         relations)
+
+        with self.env.db_transaction as db:
+            db("DELETE FROM code_comment_ticket_relations")
+            db("""
+                INSERT INTO code_comment_ticket_relations
+                 (comment_id, ticket)
+                VALUES (5, %s)
+                """, (second.id,))
+            db("""
+                UPDATE ticket_custom SET value='5'
+                WHERE name='code_comment_relation'
+                """)
+        self.assertEqual(2, UpdateTicketCodeComments(self.env)
+                            .rebuild_relations())
+        self.assertEqual(relations, self.relations())
+        self.assertEqual(relation_fields, self.relation_fields())
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TicketRelationsTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+from StringIO import StringIO
+from urlparse import parse_qs, urlparse
+
+from trac.perm import PermissionError, PermissionSystem
+from trac.test import MockRequest
+from trac.web.api import HTTPBadRequest, RequestDone
+
+from code_comments.comments import Comments
+from code_comments.tests.util import create_env, insert_comments
+from code_comments.web import CommentsExport, CommentsREST, ListComments
+
+
+class ListCommentsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+        insert_comments(self.env, [
+            ('text %d' % i, 'repos/trunk/a.py', 3, i, 'alice', 1000 + i,
+             'browser') for i in range(1, 61)])
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def list(self, **args):
+        req = MockRequest(self.env, path_info='/code-comments', args=args)
+        template, data, content_type = \
+            ListComments(self.env).process_request(req)
+        return req, data
+
+    def next_cursor(self, req):
+        href = req.chrome['links']['next'][0]['href']
+        return parse_qs(urlparse(href).query)['cursor'][0]
+
+    def test_invalid_orderby(self):
+        req, data = self.list(orderby='bogus')
+        self.assertEqual('id', data['current_sorting_method'])
+        self.assertEqual(range(60, 10, -1),
+                         [comment.id for comment in data['comments']])
+        self.list(orderby='bogus', page='2', cursor=self.next_cursor(req))
+
+    def test_lowercase_order(self):
+        req, data = self.list(orderby='time', order='asc')
+        self.assertEqual('ASC', data['current_order'])
+        self.assertEqual(range(1, 51),
+                         [comment.id for comment in data['comments']])
+        req, data = self.list(orderby='time', order='asc', page='2',
+                              cursor=self.next_cursor(req))
+        self.assertEqual(range(51, 61),
+                         [comment.id for comment in data['comments']])
+
+
+class CommentsRESTTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def post(self, body):
+        req = MockRequest(self.env, method='POST',
+                          path_info='/code-comments/comments')
+        req.environ['wsgi.input'] = StringIO(body)
+        req.environ['CONTENT_LENGTH'] = str(len(body))
+        self.assertRaises(RequestDone,
+                          CommentsREST(self.env).process_request, req)
+        return json.loads(req.response_sent.getvalue())
+
+    def get(self, etag=None, path_info='/code-comments/comments'):
+        req = MockRequest(self.env, path_info=path_info,
+                          args={'path': 'attachment:/ticket/1/fix.diff'})
+        if etag:
+            req.environ['HTTP_IF_NONE_MATCH'] = etag
+        self.assertRaises(RequestDone,
+                          CommentsREST(self.env).process_request, req)
+        return req.status_sent[0], req.headers_sent.get('ETag')
+
+    def comment(self, line):
+        return {'text': 'Line %d' % line, 'author': 'alice',
+                'path': 'attachment:/ticket/1/fix.diff', 'revision': 0,
+                'line': line, 'type': 'attachment'}
+
+    def test_post_one(self):
+        data = self.post(json.dumps(self.comment(1)))
+        self.assertEqual('Line 1', data['text'])
+
+    def test_post_many(self):
+        data = self.post(json.dumps([self.comment(1), self.comment(2)]))
+        self.assertEqual(['Line 1', 'Line 2'],
+                         [comment['text'] for comment in data])
+
+    def test_not_modified(self):
+        self.post(json.dumps(self.comment(1)))
+        status, etag = self.get()
+        self.assertEqual('200 Ok', status)
+        self.assertTrue(etag)
+        self.assertEqual('304 Not Modified', self.get(etag)[0])
+        path_info = '/code-comments/comments/counts'
+        self.assertEqual('304 Not Modified', self.get(etag, path_info)[0])
+
+    def test_etag_changes(self):
+        id = self.post(json.dumps(self.comment(1)))['id']
+        status, etag = self.get()
+        self.post(json.dumps(self.comment(2)))
+        status, created_etag = self.get(etag)
+        self.assertEqual('200 Ok', status)
+        self.assertNotEqual(etag, created_etag)
+        Comments(None, self.env).by_id(id).delete()
+        status, deleted_etag = self.get(created_etag)
+        self.assertEqual('200 Ok', status)
+        self.assertNotIn(deleted_etag, (etag, created_etag))
+        # Comments are rendered again
+        self.env.config.set('code_comments', 'html_cache_generation', '2')
+        status, rendered_etag = self.get(deleted_etag)
+        self.assertEqual('200 Ok', status)
+        self.assertNotEqual(deleted_etag, rendered_etag)
+
+    def test_post_not_objects(self):
+        for body in ('[1, 2]', json.dumps([self.comment(1), 'x']), '5',
+                     'null'):
+            self.assertRaises(HTTPBadRequest, self.post, body)
+        self.assertEqual(0, Comments(None, self.env).count())
+
+
+class CommentsExportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = create_env()
+        PermissionSystem(self.env).grant_permission('admin', 'TRAC_ADMIN')
+        insert_comments(self.env, [
+            ('text %d' % i, 'repos/trunk/a.py', 3, i, 'alice', 1000 + i,
+             'browser') for i in range(1, 4)])
+
+    def tearDown(self):
+        self.env.destroy_db()
+
+    def export(self, authname, **args):
+        req = MockRequest(self.env, authname=authname, args=args,
+                          path_info='/code-comments/export')
+        self.assertRaises(RequestDone,
+                          CommentsExport(self.env).process_request, req)
+        return [json.loads(line) for line
+                in req.response_sent.getvalue().splitlines()]
+
+    def test_export(self):
+        comments = self.export('admin')
+        self.assertEqual([1, 2, 3], [comment['id'] for comment in comments])
+        self.assertIn('html', comments[0])
+
+    def test_export_filtered_without_html(self):
+        comments = self.export('admin', line='2', html='0')
+        self.assertEqual([2], [comment['id'] for comment in comments])
+        self.assertNotIn('html', comments[0])
+
+    def test_export_requires_admin(self):
+        self.assertRaises(PermissionError, self.export, 'alice')
+        self.assertRaises(PermissionError, self.export, 'anonymous')
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ListCommentsTestCase))
+    suite.addTest(unittest.makeSuite(CommentsRESTTestCase))
+    suite.addTest(unittest.makeSuite(CommentsExportTestCase))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
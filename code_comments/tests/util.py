@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from trac.test import EnvironmentStub
+
+# Loaded by Trac from the plugin entry points otherwise
+import code_comments.comment_macro
+import code_comments.notification
+import code_comments.subscription
+import code_comments.ticket_event_listener
+import code_comments.web
+from code_comments.db import CodeCommentsSetup
+
+
+def create_env(**kwargs):
+    """
+    Returns an environment with the plugin enabled and its tables created.
+    """
+    env = EnvironmentStub(default_data=True,
+                          enable=['trac.*', 'code_comments.*'], **kwargs)
+    CodeCommentsSetup(env).upgrade_environment()
+    return env
+
+
+def insert_comments(env, rows):
+    """
+    Inserts `(text, path, revision, line, author, time, type)` rows
+    directly, without going through `Comments.create()`.
+    """
+    with env.db_transaction as db:
+        db.executemany("""
+            INSERT INTO code_comments
+             (version, text, path, revision, line, author, time, type)
+            VALUES (1, %s, %s, %s, %s, %s, %s, %s)
+            """, rows)
@@ -1,59 +1,188 @@
 # -*- coding: utf-8 -*-
 
+from trac.admin import IAdminCommandProvider
 from trac.core import Component, implements
 from trac.ticket.api import ITicketChangeListener
+from trac.util.text import printout
 
 import re
 
 from code_comments.comment_macro import CodeCommentLinkMacro
 
 
+def find_comment_ids(text):
+    return set(int(id) for id in re.findall(CodeCommentLinkMacro.re,
+                                            text or ''))
+
+
 class UpdateTicketCodeComments(Component):
     """Automatically stores relations to CodeComments whenever a ticket
-    is saved or created
-    Note: This does not catch edits on replies right away but on the next
-    change of the ticket or when adding a new reply
+    is saved or created.
+
+    Only the text touched by a change is scanned: the new comment, the
+    edited comment or the description diff. Relations that disappear from
+    that text are only dropped if no other part of the ticket still links
+    to the comment.
     """
 
-    implements(ITicketChangeListener)
+    implements(IAdminCommandProvider, ITicketChangeListener)
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('code-comments relations rebuild', '',
+               """Rebuilds the relations between tickets and comments from
+               the descriptions and comments of all tickets.
+               """,
+               None, self._do_rebuild)
+
+    # ITicketChangeListener methods
 
     def ticket_created(self, ticket):
-        self.update_relations(ticket)
+        self.update_relations(ticket,
+                              find_comment_ids(ticket['description']))
 
     def ticket_changed(self, ticket, comment, author, old_values):
-        self.update_relations(ticket)
+        added = find_comment_ids(comment)
+        removed = set()
+        if 'description' in old_values:
+            old = find_comment_ids(old_values['description'])
+            new = find_comment_ids(ticket['description'])
+            added |= new - old
+            removed |= old - new
+        self.update_relations(ticket, added, removed)
 
     def ticket_deleted(self, ticket):
-        self.update_relations(ticket)
+        self.env.db_transaction("""
+            DELETE FROM code_comment_ticket_relations WHERE ticket=%s
+            """, (ticket.id,))
+
+    def ticket_comment_modified(self, ticket, cdate, author, comment,
+                                old_comment):
+        old = find_comment_ids(old_comment)
+        new = find_comment_ids(comment)
+        self.update_relations(ticket, new - old, old - new)
 
-    def update_relations(self, ticket):
-        comment_ids = []
-        # (time, author, field, oldvalue, newvalue, permanent)
-        changes = ticket.get_changelog()
-        description = ticket['description']
+    def ticket_change_deleted(self, ticket, cdate, changes):
+        added = set()
+        if 'description' in changes:
+            # The description has been reverted to its old value
+            added = find_comment_ids(changes['description'][0])
+        # Trac leaves the deleted comment out of `changes`: check whether
+        # the remaining text still links to each related comment
+        self.update_relations(ticket, added, self.get_relations(ticket.id))
 
-        comment_ids += re.findall(CodeCommentLinkMacro.re, description)
-        if changes:
-            for change in changes:
-                if change[2] == 'comment':
-                    comment_ids += re.findall(CodeCommentLinkMacro.re,
-                                              change[4])
+    # Internal methods
 
-        comment_ids = set(comment_ids)
-        comment_ids_csv = ','.join(comment_ids)
+    def update_relations(self, ticket, added, removed=()):
+        """
+        Applies the comment ids added to and removed from a ticket's text.
+        """
+        with self.env.db_transaction as db:
+            existing = self.get_relations(ticket.id)
+            added = set(added) - existing
+            removed = self.unreferenced(ticket,
+                                        (set(removed) & existing) - added)
+            if not added and not removed:
+                return
+            comment_ids = (existing | added) - removed
+            self.set_relations(ticket.id, comment_ids)
+            self.set_relation_field(db, ticket.id, comment_ids)
+
+    def get_relations(self, ticket_id):
+        return set(comment_id for comment_id, in self.env.db_query("""
+            SELECT comment_id FROM code_comment_ticket_relations
+            WHERE ticket=%s
+            """, (ticket_id,)))
 
+    def unreferenced(self, ticket, comment_ids):
+        """
+        Returns the given comment ids that aren't linked to anymore from the
+        description or any comment of the ticket.
+        """
+        comment_ids = comment_ids - find_comment_ids(ticket['description'])
+        with self.env.db_query as db:
+            def is_linked(comment_id):
+                link = '[[CodeCommentLink(%d)]]' % comment_id
+                return db("""
+                    SELECT 1 FROM ticket_change
+                    WHERE ticket=%s AND field='comment' AND newvalue
+                    """ + db.like(),
+                    (ticket.id, '%' + db.like_escape(link) + '%'))
+            return set(comment_id for comment_id in comment_ids
+                       if not is_linked(comment_id))
+
+    def set_relations(self, ticket_id, comment_ids):
+        """
+        Makes the given comment ids the only ones related to a ticket.
+        """
         with self.env.db_transaction as db:
-            for _ in db("""
-                    SELECT * FROM ticket_custom
-                    WHERE ticket=%s AND name = 'code_comment_relation'
-                    """, (ticket.id,)):
-                db("""
-                    UPDATE ticket_custom SET value=%s
-                    WHERE ticket=%s AND name='code_comment_relation'
-                    """, (comment_ids_csv, ticket.id))
-                break
-            else:
-                db("""
-                    INSERT INTO ticket_custom (ticket, name, value)
-                    VALUES (%s, 'code_comment_relation', %s)
-                    """, (ticket.id, comment_ids_csv))
+            existing = self.get_relations(ticket_id)
+            cursor = db.cursor()
+            removed = existing - comment_ids
+            if removed:
+                cursor.executemany("""
+                    DELETE FROM code_comment_ticket_relations
+                    WHERE comment_id=%s AND ticket=%s
+                    """, [(comment_id, ticket_id) for comment_id in removed])
+            added = comment_ids - existing
+            if added:
+                cursor.executemany("""
+                    INSERT INTO code_comment_ticket_relations
+                     (comment_id, ticket)
+                    VALUES (%s, %s)
+                    """, [(comment_id, ticket_id) for comment_id in added])
+
+    def set_relation_field(self, db, ticket_id, comment_ids):
+        comment_ids_csv = ','.join(str(id) for id in sorted(comment_ids))
+        for _ in db("""
+                SELECT * FROM ticket_custom
+                WHERE ticket=%s AND name = 'code_comment_relation'
+                """, (ticket_id,)):
+            db("""
+                UPDATE ticket_custom SET value=%s
+                WHERE ticket=%s AND name='code_comment_relation'
+                """, (comment_ids_csv, ticket_id))
+            break
+        else:
+            db("""
+                INSERT INTO ticket_custom (ticket, name, value)
+                VALUES (%s, 'code_comment_relation', %s)
+                """, (ticket_id, comment_ids_csv))
+
+    def rebuild_relations(self):
+        """
+        Rebuilds all relations by scanning every ticket. Returns the number
+        of tickets linking to comments.
+        """
+        relations = {}
+        with self.env.db_transaction as db:
+            db("""
+                DELETE FROM code_comment_ticket_relations
+                WHERE ticket NOT IN (SELECT id FROM ticket)
+                """)
+            pattern = '%' + db.like_escape('[[CodeCommentLink(') + '%'
+            for ticket_id, text in db("""
+                    SELECT id, description FROM ticket
+                    WHERE description """ + db.like() + """
+                    UNION ALL
+                    SELECT ticket, newvalue FROM ticket_change
+                    WHERE field='comment' AND newvalue """ + db.like(),
+                    (pattern, pattern)):
+                relations.setdefault(ticket_id, set()) \
+                         .update(find_comment_ids(text))
+            stale = set(ticket_id for ticket_id, in db("""
+                SELECT DISTINCT ticket FROM code_comment_ticket_relations
+                UNION
+                SELECT ticket FROM ticket_custom
+                WHERE name='code_comment_relation' AND value!=''
+                """))
+            for ticket_id in stale | set(relations):
+                comment_ids = relations.get(ticket_id, set())
+                self.set_relations(ticket_id, comment_ids)
+                self.set_relation_field(db, ticket_id, comment_ids)
+        return len([ids for ids in relations.values() if ids])
+
+    def _do_rebuild(self):
+        count = self.rebuild_relations()
+        printout("Rebuilt comment relations of %d ticket(s)." % count)
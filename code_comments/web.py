@@ -1,21 +1,33 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import gzip
+import hashlib
 import json
+import os
+import posixpath
 import re
+import threading
+from cStringIO import StringIO
 
+from trac.config import BoolOption, IntOption
 from trac.core import Component, implements
+from trac.search.api import ISearchSource, shorten_result
 from trac.util import Markup
+from trac.util.datefmt import to_datetime
 from trac.util.presentation import Paginator
 from trac.util.text import to_unicode
 from trac.versioncontrol.api import RepositoryManager
 from trac.web.chrome import (
     Chrome, INavigationContributor, ITemplateProvider, add_link, add_notice,
     add_script, add_script_data, add_stylesheet)
+from trac.web.api import HTTPBadRequest, RequestDone
 from trac.web.main import IRequestHandler, IRequestFilter
 
+from code_comments.cache import CommentHTMLCache
 from code_comments.comments import Comments
 from code_comments.comment import CommentJSONEncoder, format_to_html
+from code_comments.search import CommentSearchIndex
 
 
 class CodeComments(Component):
@@ -65,8 +77,12 @@ class MainNavigation(CodeComments):
 class JSDataForRequests(CodeComments):
     implements(IRequestFilter)
 
-    js_templates = ['page-comments-block', 'comment', 'add-comment-dialog',
-                    'comment', 'comments-for-a-line']
+    embed_comments_limit = IntOption(
+        'code_comments', 'embed_comments_limit', 500,
+        doc="Comments of a page are embedded into it, so that they are "
+            "shown without further requests, unless there are more than "
+            "this many. Then, or if set to 0, they are fetched from the "
+            "comments REST endpoint.")
 
     # IRequestFilter methods
 
@@ -80,10 +96,10 @@ class JSDataForRequests(CodeComments):
 
         js_data = {
             'comments_rest_url': req.href(CommentsREST.href),
+            'comment_counts_url': req.href(CommentsREST.href, 'counts'),
             'formatting_help_url': req.href.wiki('WikiFormatting'),
             'delete_url': req.href(DeleteCommentForm.href),
             'preview_url': req.href(WikiPreview.href),
-            'templates': self.templates_js_data(),
             'active_comment_id': req.args.get('codecomment'),
             'username': req.authname,
             'is_admin': 'TRAC_ADMIN' in req.perm,
@@ -98,25 +114,51 @@ class JSDataForRequests(CodeComments):
         else:
             return original_return_value
 
-        add_script(req, 'code-comments/json2.js')
-        add_script(req, 'code-comments/underscore-min.js')
-        add_script(req, 'code-comments/backbone-min.js')
-        # jQuery UI includes: UI Core, Interactions, Button & Dialog Widgets,
-        # Core Effects, custom theme
-        # Chrome(self.env).add_jquery_ui(req)
-        add_script(req, 'code-comments/jquery-ui/jquery-ui.js')
-        add_stylesheet(req, 'code-comments/jquery-ui/trac-theme.css')
-        add_script(req, 'code-comments/jquery.ba-throttle-debounce.min.js')
-        add_script(req, 'code-comments/code-comments.js')
+        args = self.comments_args(js_data)
+        comments = self.comments_js_data(req, args)
+        if comments is not None:
+            js_data['comments'] = comments
+        else:
+            # Too many to embed, the client loads the line comments as their
+            # lines are scrolled into view
+            js_data['comment_counts'] = Comments(req, self.env) \
+                .count_by_line(dict(args, line__gt=0))
+
+        AssetBundle(self.env).add_assets(req)
         add_script_data(req, {'CodeComments': js_data})
         return original_return_value
 
-    def templates_js_data(self):
-        data = {}
-        for name in self.js_templates:
-            # we want to use the name as JS identifier and can't have dashes
-            data[name.replace('-', '_')] = self.template_js_data(name)
-        return data
+    def comments_args(self, js_data):
+        """
+        Returns the arguments the client fetches the comments of the page
+        with, as in `CommentsList.defaultFetchParams`.
+        """
+        args = {
+            'type': js_data['page'],
+            'revision': js_data['revision']
+                if js_data['revision'] is not None else '',
+        }
+        if js_data['path']:
+            args['path'] = js_data['path']
+        return args
+
+    def comments_js_data(self, req, args):
+        """
+        Returns the comments matching `args`, grouped by line, or `None` if
+        there are more than `embed_comments_limit`.
+        """
+        limit = self.embed_comments_limit
+        if limit <= 0:
+            return None
+        comments = Comments(req, self.env).search(args, per_page=limit + 1)
+        if len(comments) > limit:
+            return None
+        encoder = CommentJSONEncoder()
+        by_line = {}
+        for comment in comments:
+            by_line.setdefault(comment.line, []) \
+                .append(encoder.default(comment))
+        return by_line
 
     def changeset_js_data(self, req, data):
         return {
@@ -143,10 +185,276 @@ class JSDataForRequests(CodeComments):
             'selectorToInsertAfter': 'div#preview'
         }
 
-    def template_js_data(self, name):
-        file_name = name + '.html'
-        with open(self.get_template_dir() + '/js/' + file_name) as fd:
-            return to_unicode(fd.read())
+
+class ClientTemplates(CodeComments):
+    """
+    Serves the client-side templates as a script defining
+    `CodeCommentsTemplates`.
+
+    The URL of the script contains a hash of its content, so browsers can
+    cache it for good. The templates are read once and again only when one
+    of the files has been modified.
+    """
+    implements(IRequestHandler)
+
+    href = CodeComments.href + '/templates'
+
+    names = ['page-comments-block', 'comment', 'add-comment-dialog',
+             'comments-for-a-line', 'review-bar']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._mtimes = None
+        self._script = None
+        self._digest = None
+
+    # IRequestHandler methods
+    def match_request(self, req):
+        match = re.match(r'/%s/([0-9a-f]+)\.js$' % re.escape(self.href),
+                         req.path_info)
+        if match:
+            req.args['digest'] = match.group(1)
+            return True
+
+    def process_request(self, req):
+        script, digest = self.get_script()
+        req.send_response(200)
+        req.send_header('Content-Type', 'text/javascript; charset=utf-8')
+        req.send_header('Content-Length', len(script))
+        if req.args.get('digest') == digest:
+            req.send_header('Cache-Control',
+                            'public, max-age=31536000, immutable')
+        else:
+            # Linked from a page rendered before the templates changed
+            req.send_header('Cache-Control', 'no-cache')
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(script)
+        raise RequestDone
+
+    def script_href(self):
+        """
+        Returns the path of the script, to be passed to `add_script`.
+        """
+        script, digest = self.get_script()
+        return '/%s/%s.js' % (self.href, digest)
+
+    def get_script(self):
+        """
+        Returns the script and the hash of its content.
+        """
+        paths = [os.path.join(self.get_template_dir(), 'js', name + '.html')
+                 for name in self.names]
+        mtimes = [os.path.getmtime(path) for path in paths]
+        with self._lock:
+            if mtimes != self._mtimes:
+                templates = {}
+                for name, path in zip(self.names, paths):
+                    with open(path) as fd:
+                        # we want to use the name as JS identifier and can't
+                        # have dashes
+                        templates[name.replace('-', '_')] = \
+                            to_unicode(fd.read())
+                self._script = 'var CodeCommentsTemplates = %s;\n' \
+                    % json.dumps(templates, sort_keys=True)
+                self._digest = hashlib.sha1(self._script).hexdigest()[:16]
+                self._mtimes = mtimes
+            return self._script, self._digest
+
+
+class AssetBundle(CodeComments):
+    """
+    Serves the scripts and stylesheets of the comments frontend as one
+    script and one stylesheet, under URLs containing a hash of their
+    content, so browsers can cache them for good.
+
+    The bundles are built on first use and rebuilt only when one of the
+    files has been modified. Scripts that aren't minified already are
+    stripped of indentation, blank lines and comment lines; as this works
+    line by line, they must not contain multi-line strings.
+    """
+    implements(IRequestHandler)
+
+    href = CodeComments.href + '/bundle'
+
+    debug_assets = BoolOption('code_comments', 'debug_assets', False,
+                              doc="Include the scripts and stylesheets of "
+                                  "the comments frontend one by one and "
+                                  "unminified, instead of bundled.")
+
+    # jQuery UI includes: UI Core, Interactions, Button & Dialog Widgets,
+    # Core Effects, custom theme
+    # Chrome(self.env).add_jquery_ui(req)
+    scripts = ['code-comments/json2.js',
+               'code-comments/underscore-min.js',
+               'code-comments/backbone-min.js',
+               'code-comments/jquery-ui/jquery-ui.js',
+               'code-comments/jquery.ba-throttle-debounce.min.js',
+               ClientTemplates,
+               'code-comments/code-comments.js']
+
+    stylesheets = ['code-comments/jquery-ui/trac-theme.css']
+
+    content_types = {
+        'js': 'text/javascript; charset=utf-8',
+        'css': 'text/css; charset=utf-8',
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._bundles = {}
+
+    # IRequestHandler methods
+    def match_request(self, req):
+        match = re.match(r'/%s/([0-9a-f]+)\.(js|css)$' % re.escape(self.href),
+                         req.path_info)
+        if match:
+            req.args['digest'], req.args['kind'] = match.groups()
+            return True
+
+    def process_request(self, req):
+        kind = req.args['kind']
+        bundle = self.get_bundle(kind)
+        gzipped = 'gzip' in (req.get_header('Accept-Encoding') or '')
+        content = bundle.gzipped if gzipped else bundle.content
+        req.send_response(200)
+        req.send_header('Content-Type', self.content_types[kind])
+        req.send_header('Content-Length', len(content))
+        req.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            req.send_header('Content-Encoding', 'gzip')
+        if req.args.get('digest') == bundle.digest:
+            req.send_header('Cache-Control',
+                            'public, max-age=31536000, immutable')
+        else:
+            # Linked from a page rendered before the files changed
+            req.send_header('Cache-Control', 'no-cache')
+        req.end_headers()
+        if req.method != 'HEAD':
+            req.write(content)
+        raise RequestDone
+
+    def add_assets(self, req):
+        """
+        Adds the scripts and stylesheets to the page, bundled unless
+        `[code_comments] debug_assets` is set.
+        """
+        if self.debug_assets:
+            for script in self.scripts:
+                if script is ClientTemplates:
+                    script = ClientTemplates(self.env).script_href()
+                add_script(req, script)
+            for stylesheet in self.stylesheets:
+                add_stylesheet(req, stylesheet)
+        else:
+            add_script(req, '/%s/%s.js' % (self.href,
+                                          self.get_bundle('js').digest))
+            add_stylesheet(req, '/%s/%s.css' % (self.href,
+                                               self.get_bundle('css').digest))
+
+    def get_bundle(self, kind):
+        """
+        Returns the current `js` or `css` bundle.
+        """
+        if kind == 'js':
+            files = self.scripts
+        else:
+            files = self.stylesheets
+        key = []
+        for filename in files:
+            if filename is ClientTemplates:
+                key.append(ClientTemplates(self.env).get_script()[1])
+            else:
+                key.append(os.path.getmtime(self._htdocs_path(filename)))
+        with self._lock:
+            if kind not in self._bundles or self._bundles[kind][0] != key:
+                if kind == 'js':
+                    content = self._build_js()
+                else:
+                    content = self._build_css()
+                self._bundles[kind] = (key, _Bundle(content))
+            return self._bundles[kind][1]
+
+    # Internal methods
+
+    def _htdocs_path(self, filename):
+        prefix, path = filename.split('/', 1)
+        for htdocs_prefix, directory in self.get_htdocs_dirs():
+            if htdocs_prefix == prefix:
+                return os.path.join(directory, *path.split('/'))
+        raise ValueError("No htdocs directory for %s" % filename)
+
+    def _read(self, filename):
+        with open(self._htdocs_path(filename)) as fd:
+            return fd.read()
+
+    def _build_js(self):
+        parts = []
+        for filename in self.scripts:
+            if filename is ClientTemplates:
+                parts.append(ClientTemplates(self.env).get_script()[0])
+                continue
+            script = self._read(filename)
+            if not filename.endswith(('.min.js', '-min.js')):
+                script = _minify_js(script)
+            # Source map comments would point to the wrong place
+            script = re.sub(r'(?m)^//[#@] sourceMappingURL=.*$', '', script)
+            # The semicolon protects against scripts lacking a final one
+            parts.append('/* %s */\n%s\n;' % (filename, script.strip()))
+        return '\n'.join(parts) + '\n'
+
+    def _build_css(self):
+        parts = []
+        for filename in self.stylesheets:
+            directory = posixpath.dirname(filename)
+
+            def rebase(match):
+                # Relative to the bundle, which is two levels below the
+                # root of the application
+                url = posixpath.normpath(posixpath.join(directory,
+                                                        match.group(2)))
+                return 'url("../../chrome/%s")' % url
+            css = re.sub(r"""url\(\s*(['"]?)(?![a-z]+:|/|#)([^'")]+)\1\s*\)""",
+                         rebase, self._read(filename))
+            parts.append('/* %s */\n%s' % (filename, _minify_css(css)))
+        return '\n'.join(parts) + '\n'
+
+
+class _Bundle(object):
+    """
+    The content of a bundle, its hash and a gzipped copy.
+    """
+
+    def __init__(self, content):
+        self.content = content
+        self.digest = hashlib.sha1(content).hexdigest()[:16]
+        buf = StringIO()
+        # A fixed mtime, so the gzipped copy only depends on the content
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fd:
+            fd.write(content)
+        self.gzipped = buf.getvalue()
+
+
+def _minify_js(script):
+    """
+    Strips indentation, trailing spaces, blank lines and lines holding only
+    a `//` comment. Line breaks are kept, as they can end statements.
+    Scripts continuing strings over lines are returned unchanged.
+    """
+    lines = script.splitlines()
+    if any(line.rstrip().endswith('\\') for line in lines):
+        return script
+    return '\n'.join(line.strip() for line in lines
+                     if line.strip() and not line.strip().startswith('//'))
+
+
+def _minify_css(css):
+    """
+    Strips comments, indentation and blank lines.
+    """
+    css = re.sub(r'(?s)/\*.*?\*/', '', css)
+    return '\n'.join(line.strip() for line in css.splitlines()
+                     if line.strip())
 
 
 class ListComments(CodeComments):
@@ -165,17 +473,35 @@ class ListComments(CodeComments):
         self.args = {}
         self.req = req
 
+        self.comments = Comments(req, self.env)
         self.per_page = int(req.args.get('per-page', self.COMMENTS_PER_PAGE))
         self.page = int(req.args.get('page', 1))
+        # Normalized once: the cursors of the page links must match the
+        # order the comments are searched in
         self.order_by = req.args.get('orderby', 'id')
-        self.order = req.args.get('order', 'DESC')
+        if self.order_by not in self.comments.valid_sorting_methods:
+            self.order_by = 'id'
+        self.order = req.args.get('order', 'DESC').upper()
+        if self.order != 'ASC':
+            self.order = 'DESC'
+        self.cursor = req.args.get('cursor')
 
         self.add_path_and_author_filters()
 
-        self.comments = Comments(req, self.env)
-        self.data['comments'] = \
-            self.comments.search(self.args, self.order, self.per_page,
-                                 self.page, self.order_by)
+        if self.cursor:
+            try:
+                self.data['comments'], self.next_cursor, \
+                    self.previous_cursor = \
+                    self.comments.search_page(self.args, self.order,
+                                              self.per_page, self.cursor,
+                                              self.order_by)
+            except ValueError, e:
+                raise HTTPBadRequest(to_unicode(e))
+        else:
+            self.data['comments'] = \
+                self.comments.search(self.args, self.order, self.per_page,
+                                     self.page, self.order_by)
+            self.next_cursor = self.previous_cursor = None
         self.data['reponame'], repos, path = \
             RepositoryManager(self.env).get_repository_by_path('/')
         self.data['can_delete'] = 'TRAC_ADMIN' in req.perm
@@ -197,6 +523,7 @@ class ListComments(CodeComments):
     def add_path_and_author_filters(self):
         self.data['current_path_selection'] = ''
         self.data['current_author_selection'] = ''
+        self.data['current_query'] = ''
 
         if self.req.args.get('filter-by-path'):
             self.args['path__prefix'] = \
@@ -207,20 +534,42 @@ class ListComments(CodeComments):
             self.args['author'] = self.req.args['filter-by-author']
             self.data['current_author_selection'] = \
                 self.req.args['filter-by-author']
+        if self.req.args.get('q'):
+            self.args['q'] = self.req.args['q']
+            self.data['current_query'] = self.req.args['q']
 
     def get_paginator(self):
-        def href_with_page(page):
+        def href_with_page(page, cursor=None):
             args = copy.copy(self.req.args)
             args['page'] = page
+            if 'cursor' in args:
+                del args['cursor']
+            if cursor:
+                args['cursor'] = cursor
             return self.req.href(self.href, args)
+
+        def cursor_for(index, direction):
+            # The previous and next pages are fetched by key: they start
+            # right before the first or right after the last comment shown
+            comments = self.data['comments']
+            if not comments:
+                return None
+            return self.comments.encode_cursor(comments[index], self.order_by,
+                                               self.order, direction)
         comment_count = Comments(self.req, self.env).count(self.args)
         paginator = Paginator(self.data['comments'], self.page - 1,
                               self.per_page, comment_count)
         if paginator.has_next_page:
-            add_link(self.req, 'next', href_with_page(self.page + 1),
+            next_cursor = self.next_cursor or cursor_for(-1, 'next')
+            add_link(self.req, 'next',
+                     href_with_page(self.page + 1, next_cursor),
                      'Next Page')
         if paginator.has_previous_page:
-            add_link(self.req, 'prev', href_with_page(self.page - 1),
+            previous_cursor = self.previous_cursor or cursor_for(0, 'prev')
+            add_link(self.req, 'prev',
+                     href_with_page(self.page - 1,
+                                    previous_cursor if self.page > 2
+                                    else None),
                      'Previous Page')
         shown_pages = paginator.get_shown_pages(page_index_count=11)
         links = [{
@@ -246,6 +595,8 @@ class ListComments(CodeComments):
         query_args = self.req.args
         if 'page' in query_args:
             del query_args['page']
+        if 'cursor' in query_args:
+            del query_args['cursor']
         for sorting_method, sorting_method_name in \
                 zip(displayed_sorting_methods, displayed_sorting_method_names):
             query_args['orderby'] = sorting_method
@@ -284,16 +635,34 @@ class DeleteCommentForm(CodeComments):
     def form(self, req):
         data = {}
         referrer = req.get_header('Referer')
-        data['comment'] = Comments(req, self.env).by_id(req.args['id'])
+        data['comments'] = self.get_comments(req)
         data['return_to'] = referrer
         return 'delete.html', data, None
 
     def delete(self, req):
-        comment = Comments(req, self.env).by_id(req.args['id'])
-        comment.delete()
-        add_notice(req, 'Comment deleted.')
+        comments = self.get_comments(req)
+        Comments(req, self.env).delete_many(comments)
+        if len(comments) == 1:
+            add_notice(req, 'Comment deleted.')
+        else:
+            add_notice(req, '%d comments deleted.' % len(comments))
         req.redirect(req.args['return_to'] or req.href())
 
+    def get_comments(self, req):
+        """
+        Returns the comments selected by the comma-separated `ids` argument,
+        or the single `id` argument.
+        """
+        ids = req.args.get('ids') or req.args.get('id') or ''
+        try:
+            comments = Comments(req, self.env).by_ids(
+                id for id in ids.split(',') if id)
+        except ValueError:
+            raise HTTPBadRequest('Invalid comment id(s): %s' % ids)
+        if not comments:
+            raise HTTPBadRequest('No comments to delete.')
+        return comments
+
 
 class BundleCommentsRedirect(CodeComments):
     implements(IRequestHandler)
@@ -306,13 +675,17 @@ class BundleCommentsRedirect(CodeComments):
 
     def process_request(self, req):
         text = ''
-        for id in req.args['ids'].split(','):
-            comment = Comments(req, self.env).by_id(id)
+        try:
+            comments = Comments(req, self.env).by_ids(
+                req.args['ids'].split(','))
+        except ValueError:
+            raise HTTPBadRequest('Invalid comment ids: %s' % req.args['ids'])
+        for comment in comments:
             text += """
 [[CodeCommentLink(%(id)s)]]
 %(comment_text)s
 
-""".lstrip() % {'id': id, 'comment_text': comment.text}
+""".lstrip() % {'id': comment.id, 'comment_text': comment.text}
         req.redirect(req.href.newticket(description=text))
 
 
@@ -321,6 +694,12 @@ class CommentsREST(CodeComments):
 
     href = CodeComments.href + '/comments'
 
+    max_page_size = IntOption('code_comments', 'rest_max_page_size', 1000,
+                              doc="Maximum number of comments returned by "
+                                  "a single request to the comments REST "
+                                  "endpoint. Further pages are linked from "
+                                  "the `Link` response header.")
+
     # IRequestHandler methods
     def match_request(self, req):
         return req.path_info.startswith('/' + self.href)
@@ -328,15 +707,140 @@ class CommentsREST(CodeComments):
     def return_json(self, req, data, code=200):
         req.send(json.dumps(data, cls=CommentJSONEncoder), 'application/json')
 
+    def search(self, req):
+        """
+        Returns a page of the comments matching the request arguments and
+        links the neighbouring pages from the `Link` header.
+        """
+        args = dict(req.args)
+        cursor = args.pop('cursor', None)
+        try:
+            limit = int(args.pop('limit', self.max_page_size))
+        except ValueError:
+            raise HTTPBadRequest("Invalid limit.")
+        limit = max(1, min(limit, self.max_page_size))
+        comments = Comments(req, self.env)
+        try:
+            self.check_modified(req, comments, args)
+            comments, next_cursor, previous_cursor = \
+                comments.search_page(args, per_page=limit, cursor=cursor)
+        except ValueError, e:
+            raise HTTPBadRequest(to_unicode(e))
+        links = []
+        for rel, page_cursor in (('next', next_cursor),
+                                 ('prev', previous_cursor)):
+            if page_cursor:
+                page_args = dict(req.args, cursor=page_cursor)
+                links.append('<%s>; rel="%s"'
+                             % (req.href(self.href, page_args), rel))
+        if links:
+            req.send_header('Link', ', '.join(links))
+        return comments
+
+    def check_modified(self, req, comments, args):
+        """
+        Answers with "304 Not Modified" if the client already has the
+        current version of the matching comments, without loading them.
+        """
+        count, max_id, max_time = comments.fingerprint(args)
+        generation = CommentHTMLCache(self.env).generation
+        req.check_modified(to_datetime(max_time),
+                           ['%d:%d:%d' % (count, max_id, generation)])
+
     def process_request(self, req):
         # TODO: catch errors
         if '/' + self.href == req.path_info:
             if 'GET' == req.method:
-                self.return_json(req, Comments(req, self.env).search(req.args))
+                self.return_json(req, self.search(req))
             if 'POST' == req.method:
+                # Either a single comment, or a list of comments to create
+                # at once
                 comments = Comments(req, self.env)
-                id = comments.create(json.loads(req.read()))
-                self.return_json(req, comments.by_id(id))
+                try:
+                    data = json.loads(req.read())
+                    args_list = data if isinstance(data, list) else [data]
+                    if not all(isinstance(args, dict) for args in args_list):
+                        raise ValueError("Comments must be JSON objects.")
+                    created = comments.create_many(args_list)
+                    self.return_json(req, created if isinstance(data, list)
+                                          else created[0])
+                except ValueError, e:
+                    raise HTTPBadRequest(to_unicode(e))
+        elif '/%s/counts' % self.href == req.path_info:
+            # The number of comments per line, for the client to load the
+            # comments of the lines it shows
+            args = dict(req.args)
+            comments = Comments(req, self.env)
+            try:
+                self.check_modified(req, comments, args)
+                counts = comments.count_by_line(args)
+            except ValueError, e:
+                raise HTTPBadRequest(to_unicode(e))
+            self.return_json(req, counts)
+
+
+class CommentsExport(CodeComments):
+    """
+    Streams the comments matching the request arguments as NDJSON.
+
+    Pass `html=0` to leave out the rendered HTML.
+    """
+    implements(IRequestHandler)
+
+    href = CodeComments.href + '/export'
+
+    # IRequestHandler methods
+    def match_request(self, req):
+        return req.path_info == '/' + self.href
+
+    def process_request(self, req):
+        req.perm.require('TRAC_ADMIN')
+        args = dict(req.args)
+        html = args.pop('html', '1') not in ('0', 'false', 'no')
+        comments = Comments(req, self.env)
+        try:
+            comments.get_condition_str_and_corresponding_values(args)
+        except ValueError, e:
+            raise HTTPBadRequest(to_unicode(e))
+        req.send_response(200)
+        req.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+        req.send_header('Content-Disposition',
+                        'attachment; filename=code-comments.ndjson')
+        req.end_headers()
+        if req.method != 'HEAD':
+            # Buffered by the request in small chunks, nothing else is
+            # kept in memory
+            req.write(comments.export(args, html))
+        raise RequestDone
+
+
+class CommentsSearchSource(CodeComments):
+    """
+    Makes comments searchable from Trac's search page.
+    """
+    implements(ISearchSource)
+
+    max_search_results = IntOption('code_comments', 'search_max_results', 200,
+                                   doc="Maximum number of comments, the "
+                                       "most relevant ones, listed by "
+                                       "Trac's search.")
+
+    # ISearchSource methods
+
+    def get_search_filters(self, req):
+        if 'BROWSER_VIEW' in req.perm:
+            yield ('code-comments', 'Code comments')
+
+    def get_search_results(self, req, terms, filters):
+        if 'code-comments' not in filters:
+            return
+        ids = CommentSearchIndex(self.env).search(' '.join(terms),
+                                                  self.max_search_results)
+        for comment in Comments(req, self.env).by_ids(ids):
+            yield (comment.href(),
+                   'Comment #%d on %s' % (comment.id, comment.link_text()),
+                   to_datetime(comment.time), comment.author,
+                   shorten_result(comment.text, terms))
 
 
 class WikiPreview(CodeComments):
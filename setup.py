@@ -6,13 +6,16 @@ setup(
     author_email='nikolay@automattic.com, tott@automattic.com',
     description='Tool for leaving inline code comments',
     packages=find_packages(exclude=['*.tests*']),
+    test_suite='code_comments.tests.test_suite',
     entry_points={
         'trac.plugins': [
+            'code_comments.cache = code_comments.cache',
             'code_comments.comment = code_comments.comment',
             'code_comments.comment_macro = code_comments.comment_macro',
             'code_comments.comments = code_comments.comments',
             'code_comments.db = code_comments.db',
             'code_comments.notification = code_comments.notification',
+            'code_comments.search = code_comments.search',
             'code_comments.subscription = code_comments.subscription',
             'code_comments.ticket_event_listener = code_comments.ticket_event_listener',
             'code_comments.web = code_comments.web',